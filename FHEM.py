@@ -1,9 +1,12 @@
+
 from log import log
 import requests
 
 class FHEM:
-    
-    def __init__(self, baseURL = None, user='', passw='', l=None):
+    # long lived client, the session keeps the connection alive and the csrf token is
+    # fetched once and only refreshed if FHEM rejects a command
+
+    def __init__(self, baseURL = None, user='', passw='', l=None, pool_size=1):
         if baseURL == None:
             # Place standard url of your fhem server here
             self.__BASEURL = ''
@@ -13,8 +16,12 @@ class FHEM:
             self.__log = log('FHEM-class', True)
         else:
             self.__log = l
+        self.__token          = None
         self.__session        = requests.session()
         self.__session.auth   = (user, passw)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
         # Place your server certificate here if you use https
         self.__session.verify = '/etc/ssl/certs'
         if self.__session.verify == False:
@@ -23,34 +30,55 @@ class FHEM:
 
 
     def __repr__(self):
-        return 'FHEM(' + self.__BASEURL + ', ' + self.__session.auth[0] + ', ' + self.__session.auth[1] + ', ' + self.__log + ')'
+        return 'FHEM(' + self.__BASEURL + ', ' + self.__session.auth[0] + ', ' + self.__log.__repr__() + ')'
+
 
-    
     def get_token(self, url):
+        token = ''
         try:
-            self.__log.logMsg('Initiating connection with FHEM server: ' + url, 3)
-            r = self.__session.get(url)
+            self.__log.logMsg('Initiating connection with FHEM server: ' + url, 4)
+            r = self.__session.get(url, params={'XHR': '1'})
         except requests.exceptions.RequestException as e:
             self.__log.logMsg('Requests error when getting token: ' + str(e), 2)
         else:
-            token = r.text
-            token = token[token.find('csrf_'):]
-            token = token[:token.find("\'")]
+            token = r.headers.get('X-FHEM-csrfToken', '')
+            if not token:
+                token = r.text
+                token = token[token.find('csrf_'):]
+                token = token[:token.find("\'")]
             self.__log.logMsg('Received token from FHEM server: ' + token, 4)
         return token
 
-    
+    def refresh_token(self):
+        self.__token = self.get_token(self.__BASEURL)
+        return self.__token
+
+
     def send_command(self, cmd):
         # cmd is the FHEM command
-        # type: (object) -> object
-        # url = self.__BASEURL + 'cmd=set+licht+on'
-        url   = self.__BASEURL
-        token = self.get_token(url)
-        data  = {'fwcsrf': token}
-        url   = url + 'cmd=' + cmd
-        try:
-            self.__log.logMsg('Sending data to FHEM server: ' + url, 4)
-            self.__session.get(url, data=data)
-        except requests.exceptions.RequestException as e:
-            self.__log.logMsg('Requests error when posting command: ' + str(e), 2)
-        
+        return self.send_commands([cmd])
+
+    def send_commands(self, cmds):
+        # all commands are joined to a single request: set a b 1;set a c 2
+        if not cmds:
+            return True
+        if self.__token is None:
+            self.refresh_token()
+        params = {'cmd': ';'.join(cmds), 'XHR': '1'}
+        for retry in range(2):
+            params['fwcsrf'] = self.__token
+            try:
+                self.__log.logMsg(f'Sending {len(cmds)} commands to FHEM server', 4)
+                r = self.__session.get(self.__BASEURL, params=params)
+            except requests.exceptions.RequestException as e:
+                self.__log.logMsg('Requests error when posting command: ' + str(e), 2)
+                return False
+            if r.status_code != 400 or retry:
+                break
+            # FHEM answers 400 on a wrong csrf token, i.e. after a restart of FHEM
+            self.__log.logMsg('FHEM rejected the command, refreshing token', 3)
+            self.refresh_token()
+        if r.status_code >= 300:
+            self.__log.logMsg(f'FHEM error {r.status_code} when posting command', 2)
+            return False
+        return True
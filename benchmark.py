@@ -0,0 +1,517 @@
+#!/usr/bin/python3
+
+# Benchmarks for the proxy, runs against a local fake enverbridge and a local fake portal.
+# call is benchmark.py <benchmark> [options], see benchmark.py -h
+
+import os
+import sys
+import time
+import socket
+import select
+import asyncio
+import argparse
+import timeit
+import resource
+import collections
+import statistics
+import tempfile
+import threading
+import multiprocessing
+import urllib.parse
+import http.server
+from iotproxy import TCPProxy
+from enverdecode import DECODERS, format_record
+from enverframe import EnverFrameParser
+from enverhandlers import HandlerRegistry, DEFAULT_HANDLERS
+from capture import read_capture
+import enverstore
+from log import log
+
+ACCOUNT = bytes.fromhex('12345678')
+
+
+def make_frame(cmd, payload=b'', account=ACCOUNT):
+    # cmd is the 6 byte header (68 llll 68 10cc), the crc is unknown, so use a fixed one
+    return bytes.fromhex(cmd) + account + payload + b'\x00\x16'
+
+
+def poll_frame():
+    return make_frame('680030681006', bytes(36))
+
+
+def ack_frame():
+    return make_frame('680012681015', bytes.fromhex('1402070d0000'))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, values):
+    print(f'{name:10} n={len(values)} mean={statistics.mean(values) * 1000:.3f}ms '
+          f'p50={percentile(values, 50) * 1000:.3f}ms p99={percentile(values, 99) * 1000:.3f}ms')
+
+
+class LegacyProxy:
+    # reduced copy of the former select() based TCPProxy.loop(), used as reference only
+    BUFFSIZE = 1024
+
+    def __init__(self, listen_port, forward_port):
+        self._forward_port = forward_port
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('127.0.0.1', listen_port))
+        self._listener.listen(2)
+        self._socket_list = [self._listener]
+        self._forward_dict = {}
+
+    def loop(self):
+        while True:
+            time.sleep(0.01)
+            inputready, _, _ = select.select(self._socket_list, [], [])
+            for s_in in inputready:
+                if s_in.fileno() < 0:
+                    # closed as peer of a socket before
+                    continue
+                if s_in == self._listener:
+                    self._socket_list.append(self._listener.accept()[0])
+                    continue
+                try:
+                    data = s_in.recv(self.BUFFSIZE)
+                except OSError:
+                    data = b''
+                if not data:
+                    s_out = self._forward_dict.pop(s_in, None)
+                    for s in (s_in, s_out):
+                        if s is not None:
+                            s.close()
+                            self._forward_dict.pop(s, None)
+                            if s in self._socket_list:
+                                self._socket_list.remove(s)
+                    continue
+                if s_in not in self._forward_dict:
+                    s_out = socket.create_connection(('127.0.0.1', self._forward_port), 10)
+                    self._forward_dict[s_in] = s_out
+                    self._forward_dict[s_out] = s_in
+                    self._socket_list.append(s_out)
+                self._forward_dict[s_in].send(data)
+
+
+def run_proxy(engine, listen_port, forward_port):
+    if engine == 'select':
+        LegacyProxy(listen_port, forward_port).loop()
+    else:
+        TCPProxy('127.0.0.1', listen_port, '127.0.0.1', forward_port, log('bench', log.ERROR, 'stderr')).loop()
+
+
+async def fake_portal(reader, writer):
+    # answer every frame with a server ack
+    try:
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                break
+            writer.write(ack_frame())
+            await writer.drain()
+    except (OSError, asyncio.CancelledError):
+        pass
+    writer.close()
+
+
+async def fake_bridge(port, count, results):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    frame = poll_frame()
+    for _ in range(count):
+        start = time.perf_counter()
+        writer.write(frame)
+        await writer.drain()
+        await reader.read(1024)
+        results.append(time.perf_counter() - start)
+    writer.close()
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+async def latency_run(engine, bridges, frames):
+    portal = await asyncio.start_server(fake_portal, '127.0.0.1', 0)
+    forward_port = portal.sockets[0].getsockname()[1]
+    listen_port = free_port()
+    proc = multiprocessing.Process(target=run_proxy, args=(engine, listen_port, forward_port), daemon=True)
+    proc.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', listen_port), 1).close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    results = []
+    await asyncio.gather(*[fake_bridge(listen_port, frames, results) for _ in range(bridges)])
+    proc.terminate()
+    proc.join()
+    portal.close()
+    return results
+
+
+def latency(args):
+    for engine in args.engines:
+        report(engine, asyncio.run(latency_run(engine, args.bridges, args.frames)))
+
+
+def legacy_decode(data):
+    # former Enverproxy.process_data without publishing, used as reference only
+    results = []
+    pos = 0
+    wrid = data[pos:pos+4].hex()
+    while pos < len(data):
+        if wrid != '00000000':
+            status = data[pos+4:pos+6].hex()
+            dc = '{0:.2f}'.format(int.from_bytes(data[pos+6:pos+8],"big") / 512)
+            power = '{0:.2f}'.format(int.from_bytes(data[pos+8:pos+10],"big") / 64)
+            total = '{0:.2f}'.format(int.from_bytes(data[pos+10:pos+14],"big") / 8192)
+            temp = '{0:.2f}'.format(int.from_bytes(data[pos+14:pos+16],"big") / 128 - 40)
+            ac = '{0:.2f}'.format(int.from_bytes(data[pos+16:pos+18],"big") / 64)
+            freq = '{0:.2f}'.format(int.from_bytes(data[pos+18:pos+20],"big") / 256)
+            remaining = data[pos+20:pos+32].hex()
+            if status == '3021':
+                results.append({'wrid' : wrid, 'status' : status, 'dc' : dc, 'power' : power, 'totalkwh' : total, 'temp' : temp, 'ac' : ac, 'freq' : freq, 'remaining' : remaining})
+            else:
+                results.append({'wrid' : wrid, 'status' : status, 'ac' : ac, 'freq' : freq, 'remaining' : remaining})
+        pos += 32
+        wrid = data[pos:pos+4].hex()
+    return results
+
+
+def inverter_payload(populated, slots=30):
+    # payload of a 6803d6681004 frame (data[20:-2]), populated blocks spread over all slots
+    # so there are empty blocks in the middle
+    blocks = [bytes(32)] * slots
+    step = slots / populated
+    for i in range(populated):
+        blocks[int(i * step)] = bytes.fromhex(f'{0x12880000 + i:08x}' '30212b643707' '0000b276' '22403b1d31fd') + bytes(12)
+    return b''.join(blocks)
+
+
+def decode(args):
+    for populated in args.populated:
+        data = inverter_payload(populated)
+        assert [format_record(r) for r in DECODERS['struct'](data)] == legacy_decode(data)
+        runs = [('legacy', legacy_decode)] + list(DECODERS.items())
+        for name, decoder in runs:
+            t = min(timeit.repeat(lambda: decoder(data), number=args.number, repeat=5)) / args.number
+            print(f'{populated:2} inverters {name:8} {t * 1e6:8.2f}us/frame')
+
+
+class BenchProxy:
+    # stand-in for Enverproxy with the same per frame logging, without sinks
+    def __init__(self, logger):
+        self._log = logger
+        self._log_hex = False
+        self._server_ack = {}
+        self._handlers = HandlerRegistry()
+        for handler in DEFAULT_HANDLERS:
+            self._handlers.register(handler())
+
+    def process_data(self, data, account=None):
+        for record in DECODERS['struct'](data):
+            self._log.logMsg('%s', log.INFO, record)
+
+    def data_cb(self, data_type, data):
+        self._log.logMsg('callback for %sdata (%d)', log.DEBUG, data_type, len(data))
+        handler = self._handlers.lookup(data_type, data)
+        return data if handler is None else handler.dispatch(self, data)
+
+
+def eager_frame(logger, proxy, frame, peer):
+    # the former f-string calls of one frame, built before the level check
+    logger.logMsg(f'received: {len(frame)} bytes from {peer}', log.DEBUG)
+    logger.logMsg(f'clientdata to handle ({len(frame)})', log.DEBUG)
+    logger.logMsg(f'callback for clientdata ({len(frame)})', log.DEBUG)
+    for record in DECODERS['struct'](frame[20:-2]):
+        logger.logMsg(f'{record}', log.INFO)
+    logger.logMsg(f'Data forwarded to {peer}', log.DEBUG)
+    logger.logMsg('Remaining input list: ' + str([peer] * 4), log.DEBUG)
+
+
+def logging_overhead(args):
+    frame = make_frame('6803d6681004', bytes.fromhex('1402070d') + bytes(6) + inverter_payload(args.populated))
+    peer = ('192.168.1.20', 50000)
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+    try:
+        for level in range(1, 6):
+            logger = log('bench', level, 'stderr')
+            proxy = TCPProxy('127.0.0.1', 0, '127.0.0.1', 0, logger)
+            bench = BenchProxy(logger)
+            proxy.register_callback(bench.data_cb)
+            proxy.set_framer(EnverFrameParser)
+            session = proxy.open_session()
+
+            def lazy():
+                logger.logMsg('received: %d bytes from %s', log.DEBUG, len(frame), peer)
+                proxy.handle_read(session, 'client', frame)
+                logger.logMsg('Data forwarded to %s', log.DEBUG, peer)
+
+            t_lazy = min(timeit.repeat(lazy, number=args.number, repeat=3)) / args.number
+            t_eager = min(timeit.repeat(lambda: eager_frame(logger, proxy, frame, peer), number=args.number, repeat=3)) / args.number
+            proxy._listener.close()
+            print(f'level {level}: frame path {t_lazy * 1e6:8.2f}us   decode + former eager logging {t_eager * 1e6:8.2f}us')
+    finally:
+        log.stop_all()
+        sys.stderr.close()
+        sys.stderr = stderr
+
+
+def synthetic_capture(frames, populated=10):
+    # one bridge sending monitor data and polls, one frame per second
+    mon = make_frame('6803d6681004', bytes.fromhex('1402070d') + bytes(6) + inverter_payload(populated))
+    poll = poll_frame()
+    return [(float(i), 'client', 1, mon if i % 2 == 0 else poll) for i in range(frames)]
+
+
+def run_replay_proxy(engine, listen_port, forward_port):
+    if engine == 'select':
+        LegacyProxy(listen_port, forward_port).loop()
+        return
+    logger = log('bench', log.ERROR, 'stderr')
+    proxy = TCPProxy('127.0.0.1', listen_port, '127.0.0.1', forward_port, logger)
+    if engine == 'asyncio':
+        proxy.set_framer(EnverFrameParser)
+        proxy.register_callback(BenchProxy(logger).data_cb)
+    # raw: no framer and callbacks, the reads are passed through as they are
+    proxy.loop()
+
+
+class ReplayPortal:
+    # fake portal, takes the time each frame arrives, frames are matched to the sending
+    # bridge by the account bytes, each bridge has its own account
+    def __init__(self):
+        self.sent = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.last = 0
+
+    async def handle(self, reader, writer):
+        parser = EnverFrameParser('client', log('bench', log.ERROR, 'stderr'))
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                now = time.perf_counter()
+                for frame in parser.feed(data):
+                    queue = self.sent[bytes(frame[6:10])]
+                    if queue:
+                        self.latencies.append(now - queue.popleft())
+                    writer.write(ack_frame())
+                self.last = now
+                await writer.drain()
+        except (OSError, asyncio.CancelledError):
+            pass
+        writer.close()
+
+
+async def replay_bridge(port, index, frames, speed, portal):
+    # returns the number of frames sent, a bridge stops if the proxy drops its connection
+    account = (0x10000000 + index).to_bytes(4, 'big')
+    sent = 0
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        return sent
+
+    async def drain_answers():
+        try:
+            while await reader.read(65536):
+                pass
+        except OSError:
+            pass
+
+    answers = asyncio.ensure_future(drain_answers())
+    start = time.perf_counter()
+    t0 = frames[0][0]
+    try:
+        for timestamp, data_type, conn_id, frame in frames:
+            if speed:
+                delay = start + (timestamp - t0) / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            frame = frame[:6] + account + frame[10:]
+            portal.sent[account].append(time.perf_counter())
+            writer.write(frame)
+            await writer.drain()
+            sent += 1
+        # wait for the portal
+        deadline = time.perf_counter() + 10
+        while portal.sent[account] and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+    except OSError:
+        pass
+    finally:
+        answers.cancel()
+        writer.close()
+    return sent
+
+
+async def replay_run(engine, frames, bridges, speed):
+    portal = ReplayPortal()
+    server = await asyncio.start_server(portal.handle, '127.0.0.1', 0)
+    forward_port = server.sockets[0].getsockname()[1]
+    listen_port = free_port()
+    proc = multiprocessing.Process(target=run_replay_proxy, args=(engine, listen_port, forward_port), daemon=True)
+    proc.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', listen_port), 1).close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    bridge_runs = [replay_bridge(listen_port, i, frames, speed, portal) for i in range(bridges)]
+    try:
+        await asyncio.wait_for(asyncio.gather(*bridge_runs), len(frames) * 0.1 + 30)
+    except asyncio.TimeoutError:
+        pass
+    total = len(frames) * bridges
+    elapsed = max(portal.last - start, 1e-9)
+    proc.terminate()
+    proc.join()
+    server.close()
+    used = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = used.ru_utime + used.ru_stime - usage.ru_utime - usage.ru_stime
+    return portal.latencies, total, elapsed, cpu
+
+
+def replay(args):
+    if args.capture:
+        frames = [f for f in read_capture(args.capture) if f[1] == 'client']
+    else:
+        frames = synthetic_capture(args.frames)
+    for engine in args.engines:
+        latencies, total, elapsed, cpu = asyncio.run(replay_run(engine, frames, args.bridges, args.speed))
+        n = len(latencies) or 1
+        print(f'{engine:8} {len(latencies)}/{total} frames {len(latencies) / elapsed:9.1f} frames/s '
+              f'p50={percentile(latencies, 50) * 1000:.3f}ms p99={percentile(latencies, 99) * 1000:.3f}ms '
+              f'cpu={cpu / n * 1e6:.1f}us/frame')
+
+
+def store(args):
+    records = DECODERS['struct'](inverter_payload(30))
+    with tempfile.TemporaryDirectory() as directory:
+        writer = enverstore.StoreWriter(directory)
+        now = time.time()
+        start = time.perf_counter()
+        for i in range(args.records):
+            writer.append(records[i % len(records)], now + i * 0.01)
+        writer.close()
+        elapsed = time.perf_counter() - start
+        print(f'write   {elapsed / args.records * 1e6:6.2f}us/record')
+        start = time.perf_counter()
+        n = sum(1 for _ in enverstore.scan(directory))
+        print(f'scan    {(time.perf_counter() - start) / n * 1e6:6.2f}us/record ({n} records)')
+        start = time.perf_counter()
+        enverstore.daily_energy(directory)
+        print(f'energy  {(time.perf_counter() - start) / n * 1e6:6.2f}us/record')
+
+
+class FhemStub(http.server.BaseHTTPRequestHandler):
+    # answers like FHEMWEB: the csrf token in the header, 400 on a missing or wrong token
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 65536
+    TOKEN = 'csrf_123456789012345'
+    requests = 0
+    commands = 0
+
+    def do_GET(self):
+        FhemStub.requests += 1
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        status = 200
+        if 'cmd' in query:
+            if query.get('fwcsrf', [''])[0] != self.TOKEN:
+                status = 400
+            else:
+                FhemStub.commands += query['cmd'][0].count(';') + 1
+        body = f"<html><body fwcsrf='{self.TOKEN}'></body></html>".encode()
+        self.send_response(status)
+        self.send_header('X-FHEM-csrfToken', self.TOKEN)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def fhem_records(inverters):
+    return [{'wrid': f'{0x12880000 + i:08x}', 'status': '3021', 'dc': '32.50', 'power': '220.13', 'totalkwh': '1234.56',
+             'temp': '35.20', 'ac': '231.00', 'freq': '50.01', 'remaining': '000000000000000000000000'}
+            for i in range(inverters)]
+
+
+def fhem(args):
+    from FHEM import FHEM
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FhemStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/fhem?'
+    logger = log('bench', log.ERROR, 'stderr')
+    records = fhem_records(args.inverters)
+    cmds = [[f'set wr_{v["wrid"]} {k} {x}' for k, x in v.items()] for v in records]
+    # former publish_data: a new client per inverter, token + command request per value
+    FhemStub.requests = FhemStub.commands = 0
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        for c in cmds:
+            client = FHEM(url, '', '', logger)
+            for cmd in c:
+                client.refresh_token()
+                client.send_commands([cmd])
+    print(f'per value  requests={FhemStub.requests} commands={FhemStub.commands} '
+          f'time={(time.perf_counter() - start) * 1000:.1f}ms')
+    # long lived client, one request per frame
+    FhemStub.requests = FhemStub.commands = 0
+    client = FHEM(url, '', '', logger)
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        client.send_commands([cmd for c in cmds for cmd in c])
+    print(f'batched    requests={FhemStub.requests} commands={FhemStub.commands} '
+          f'time={(time.perf_counter() - start) * 1000:.1f}ms')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Enverproxy benchmarks')
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+    p = sub.add_parser('latency', help='round trip latency bridge -> proxy -> portal -> bridge')
+    p.add_argument('--engines', nargs='+', default=['select', 'asyncio'], choices=['select', 'asyncio'])
+    p.add_argument('--bridges', type=int, default=1)
+    p.add_argument('--frames', type=int, default=200)
+    p.set_defaults(func=latency)
+    p = sub.add_parser('fhem', help='FHEM requests per frame against a local FHEMWEB stub')
+    p.add_argument('--inverters', type=int, default=30)
+    p.add_argument('--frames', type=int, default=10)
+    p.set_defaults(func=fhem)
+    p = sub.add_parser('decode', help='decoding of 6803d6681004 inverter blocks')
+    p.add_argument('--populated', type=int, nargs='+', default=[1, 10, 30])
+    p.add_argument('--number', type=int, default=2000)
+    p.set_defaults(func=decode)
+    p = sub.add_parser('store', help='writes to and reads from the local measurement store')
+    p.add_argument('--records', type=int, default=100000)
+    p.set_defaults(func=store)
+    p = sub.add_parser('logging', help='per frame overhead of the proxy path at each log level')
+    p.add_argument('--populated', type=int, default=10)
+    p.add_argument('--number', type=int, default=1000)
+    p.set_defaults(func=logging_overhead)
+    p = sub.add_parser('replay', help='replay a capture (or synthetic frames) from N simulated bridges')
+    p.add_argument('--capture', help='capture file written by the proxy (capture = ... in the config)')
+    p.add_argument('--frames', type=int, default=1000, help='number of synthetic frames without capture')
+    p.add_argument('--bridges', type=int, default=10)
+    p.add_argument('--speed', type=float, default=0, help='speed multiplier of the capture timing, 0 = no delay')
+    p.add_argument('--engines', nargs='+', default=['select', 'asyncio', 'raw'], choices=['select', 'asyncio', 'raw'])
+    p.set_defaults(func=replay)
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,57 @@
+
+import time
+import struct
+
+# Capture file of the proxied frames
+#
+# file header: b'IOTCAP' + version (1 byte)
+# per frame:   timestamp (double, unix time) direction (1 byte, 0 = client, 1 = server)
+#              connection id (uint32) length (uint32) raw frame
+MAGIC     = b'IOTCAP'
+VERSION   = 1
+RECORD    = struct.Struct('>dBII')
+DIRECTION = {'client' : 0, 'server' : 1}
+DATA_TYPE = ('client', 'server')
+
+
+class CaptureWriter:
+
+    def __init__(self, filename, buffering=65536):
+        self._filename = filename
+        self._file     = open(filename, 'ab', buffering=buffering)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC + bytes([VERSION]))
+        self.frames    = 0
+
+    def __repr__(self):
+        return f'CaptureWriter({self._filename}, {self.frames} frames)'
+
+    def write(self, data_type, conn_id, frame, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._file.write(RECORD.pack(timestamp, DIRECTION[data_type], conn_id, len(frame)))
+        self._file.write(frame)
+        self.frames += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(filename):
+    # yields (timestamp, data_type, connection id, frame)
+    with open(filename, 'rb') as f:
+        header = f.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC or header[len(MAGIC)] != VERSION:
+            raise ValueError(f'{filename} is no capture file')
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            timestamp, direction, conn_id, length = RECORD.unpack(head)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield timestamp, DATA_TYPE[direction], conn_id, frame
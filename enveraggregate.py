@@ -0,0 +1,190 @@
+
+import time
+from collections import deque
+
+
+class Window:
+    # min, max and average of the values of the last span seconds.
+    # The minimum and maximum are kept in monotonic deques, so an update is O(1) amortized
+    # and the stats are read in O(1).
+    __slots__ = ('span', '_values', '_sum', '_min', '_max')
+
+    def __init__(self, span):
+        self.span    = span
+        self._values = deque()
+        self._sum    = 0.0
+        self._min    = deque()
+        self._max    = deque()
+
+    def add(self, now, value):
+        self._values.append((now, value))
+        self._sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((now, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((now, value))
+        self.expire(now)
+
+    def expire(self, now):
+        limit = now - self.span
+        values = self._values
+        while values[0][0] <= limit:
+            self._sum -= values.popleft()[1]
+        while self._min[0][0] <= limit:
+            self._min.popleft()
+        while self._max[0][0] <= limit:
+            self._max.popleft()
+        if len(values) == 1:
+            # no drift of the running sum
+            self._sum = values[0][1]
+
+    def stats(self):
+        if not self._values:
+            return None
+        return {'min' : self._min[0][1], 'max' : self._max[0][1], 'avg' : self._sum / len(self._values)}
+
+
+class EnergyCounter:
+    # increase of the totalkwh counter of an inverter,
+    # a counter going down is taken as reset (counting again from 0)
+    __slots__ = ('last',)
+
+    def __init__(self):
+        self.last = None
+
+    def update(self, total):
+        if self.last is None:
+            delta = 0.0
+        elif total >= self.last:
+            delta = total - self.last
+        else:
+            delta = total
+        self.last = total
+        return delta
+
+
+class Node:
+    # running state of an inverter, a bridge or the whole site
+    __slots__ = ('power', 'energy', 'day', 'windows', 'counter', 'bridge')
+
+    def __init__(self, spans, counter=None):
+        self.power   = 0.0
+        self.energy  = 0.0
+        self.day     = None
+        self.windows = [Window(span) for span in spans]
+        # inverters only: their totalkwh counter and the bridge node they are counted in
+        self.counter = counter
+        self.bridge  = None
+
+    def add_energy(self, day, delta):
+        # energy since midnight
+        if day != self.day:
+            self.day    = day
+            self.energy = 0.0
+        self.energy += delta
+
+    def rollup(self, day):
+        windows = {}
+        for window in self.windows:
+            stats = window.stats()
+            if stats is not None:
+                windows[str(window.span)] = {k : round(v, 2) for k, v in stats.items()}
+        return {'power'        : round(self.power, 2),
+                'energy_today' : round(self.energy if day == self.day else 0.0, 3),
+                'windows'      : windows}
+
+
+class Aggregator:
+    # Rolling stats per inverter, per bridge and of the site (all bridges), updated per frame:
+    # power (inverters in standby count 0), min/max/avg of the power over the windows
+    # (seconds) and the energy since midnight from the totalkwh counters.
+    # update() returns one rollup of the bridge of the frame, with the site totals and its inverters.
+    # The energy counts from the first frame of an inverter, after a restart seed() takes the energy
+    # of the day so far (i.e. from the store), else the energy before the start is missing until midnight.
+
+    def __init__(self, windows=(300, 900, 3600)):
+        self._spans     = tuple(windows)
+        self._inverters = {}
+        self._bridges   = {}
+        self._site      = Node(self._spans)
+        self._day       = None
+        self._day_end   = 0
+
+    def __repr__(self):
+        return f'Aggregator({len(self._bridges)} bridges, {len(self._inverters)} inverters, {self._spans})'
+
+    def set_day(self, now):
+        if now >= self._day_end:
+            t = time.localtime(now)
+            self._day = time.strftime('%Y-%m-%d', t)
+            self._day_end = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        return self._day
+
+    def seed(self, energy, now=None):
+        # energy of today before the start {wrid : (kwh, last totalkwh)}, counted for the bridge
+        # of an inverter with its first frame
+        day = self.set_day(time.time() if now is None else now)
+        for wrid, (kwh, total) in energy.items():
+            inverter = self._inverters.get(wrid)
+            if inverter is None:
+                inverter = self._inverters[wrid] = Node(self._spans, EnergyCounter())
+                inverter.counter.last = total
+                inverter.add_energy(day, kwh)
+                self._site.add_energy(day, kwh)
+
+    def set_windows(self, windows):
+        # new windows on reload, the power and the energy of today are kept,
+        # the stats of a window which is not configured any more are dropped
+        spans = tuple(windows)
+        for node in [self._site, *self._bridges.values(), *self._inverters.values()]:
+            old = {window.span : window for window in node.windows}
+            node.windows = [old.get(span) or Window(span) for span in spans]
+        self._spans = spans
+
+    def update(self, records, bridge=None, now=None):
+        if now is None:
+            now = time.time()
+        day = self.set_day(now)
+        site = self._site
+        node = self._bridges.get(bridge)
+        if node is None:
+            node = self._bridges[bridge] = Node(self._spans)
+        inverters = {}
+        for record in records:
+            wrid = record['wrid']
+            inverter = self._inverters.get(wrid)
+            if inverter is None:
+                inverter = self._inverters[wrid] = Node(self._spans, EnergyCounter())
+            if inverter.bridge is not node:
+                # first frame of the inverter or it is now connected to another bridge
+                if inverter.bridge is not None:
+                    inverter.bridge.power -= inverter.power
+                elif inverter.day == day:
+                    # seeded energy of today
+                    node.add_energy(day, inverter.energy)
+                node.power += inverter.power
+                inverter.bridge = node
+            power = record.get('power', 0.0)
+            delta = power - inverter.power
+            inverter.power = power
+            node.power += delta
+            site.power += delta
+            for window in inverter.windows:
+                window.add(now, power)
+            if 'totalkwh' in record:
+                energy = inverter.counter.update(record['totalkwh'])
+                inverter.add_energy(day, energy)
+                node.add_energy(day, energy)
+                site.add_energy(day, energy)
+            inverters[f'{wrid:08x}'] = inverter.rollup(day)
+        for window in node.windows:
+            window.add(now, node.power)
+        for window in site.windows:
+            window.add(now, site.power)
+        rollup = {'bridge' : '-' if bridge is None else bridge.hex(), 'timestamp' : round(now, 3)}
+        rollup.update(node.rollup(day))
+        rollup['site'] = site.rollup(day)
+        rollup['inverters'] = inverters
+        return rollup
@@ -0,0 +1,92 @@
+
+import struct
+import importlib.util
+
+# Information from bytearray of one inverter (length is 32 bytes)
+# 0        4    6    8    10       14   16   18   20                       32
+# -------------------------------------------------------------------------------------------
+# wrid     stat dc   pwr  totalkWh temp ac   freq remain
+# -------------------------------------------------------------------------------------------
+# 12881870 3021 2b64 3707 0000b276 2240 3b1d 31fd 000000000000000000000000
+INVERTER = struct.Struct('>IHHHIHHH12s')
+ACTIVE   = 0x3021
+
+# (numpy, dtype of an inverter block), numpy is only imported if the numpy decoder is used
+NUMPY = None
+
+
+def load_numpy():
+    global NUMPY
+    if NUMPY is None:
+        import numpy
+        NUMPY = (numpy, numpy.dtype([('wrid', '>u4'), ('status', '>u2'), ('dc', '>u2'), ('power', '>u2'),
+                                     ('totalkwh', '>u4'), ('temp', '>u2'), ('ac', '>u2'), ('freq', '>u2'),
+                                     ('remaining', 'V12')]))
+    return NUMPY
+
+
+def decode_inverters(data):
+    # decode all inverter blocks of a 6803d6681004 payload in one pass,
+    # empty blocks (wrid 0) may be anywhere and are skipped
+    # returns records with int wrid/status, float values and the raw remaining bytes
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % INVERTER.size]
+    records = []
+    for wrid, status, dc, power, total, temp, ac, freq, remaining in INVERTER.iter_unpack(view):
+        if wrid == 0:
+            continue
+        if status == ACTIVE:
+            records.append({'wrid' : wrid, 'status' : status, 'dc' : dc / 512, 'power' : power / 64,
+                            'totalkwh' : total / 8192, 'temp' : temp / 128 - 40, 'ac' : ac / 64,
+                            'freq' : freq / 256, 'remaining' : remaining})
+        else:
+            # standby, dc, power, totalkwh and temp are not filled
+            records.append({'wrid' : wrid, 'status' : status, 'ac' : ac / 64, 'freq' : freq / 256,
+                            'remaining' : remaining})
+    return records
+
+
+def decode_inverters_numpy(data):
+    # same as decode_inverters, scaling is done on all blocks at once
+    numpy, dtype = NUMPY or load_numpy()
+    blocks = numpy.frombuffer(data, dtype, len(data) // dtype.itemsize)
+    blocks = blocks[blocks['wrid'] != 0]
+    wrids  = blocks['wrid'].tolist()
+    status = blocks['status'].tolist()
+    dc     = (blocks['dc'] / 512).tolist()
+    power  = (blocks['power'] / 64).tolist()
+    total  = (blocks['totalkwh'] / 8192).tolist()
+    temp   = (blocks['temp'] / 128 - 40).tolist()
+    ac     = (blocks['ac'] / 64).tolist()
+    freq   = (blocks['freq'] / 256).tolist()
+    remain = [bytes(r) for r in blocks['remaining']]
+    records = []
+    for i, wrid in enumerate(wrids):
+        if status[i] == ACTIVE:
+            records.append({'wrid' : wrid, 'status' : status[i], 'dc' : dc[i], 'power' : power[i],
+                            'totalkwh' : total[i], 'temp' : temp[i], 'ac' : ac[i],
+                            'freq' : freq[i], 'remaining' : remain[i]})
+        else:
+            records.append({'wrid' : wrid, 'status' : status[i], 'ac' : ac[i], 'freq' : freq[i],
+                            'remaining' : remain[i]})
+    return records
+
+
+DECODERS = {'struct' : decode_inverters}
+if importlib.util.find_spec('numpy') is not None:
+    DECODERS['numpy'] = decode_inverters_numpy
+
+
+def format_record(record):
+    # string representation as published to the sinks, wrid and status as hex
+    result = {}
+    for key, value in record.items():
+        if key == 'wrid':
+            result[key] = f'{value:08x}'
+        elif key == 'status':
+            result[key] = f'{value:04x}'
+        elif key == 'remaining':
+            result[key] = value.hex()
+        else:
+            result[key] = f'{value:.2f}'
+    return result
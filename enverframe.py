@@ -0,0 +1,85 @@
+
+from log import log
+
+
+class EnverFrameParser:
+    # Incremental parser for the envertec protocol, one instance per connection and direction.
+    # Each frame starts with 68 llll 68 and ends with 16, llll is the length of the whole frame.
+    #
+    # feed() returns the complete frames found so far. A read holding exactly one frame is
+    # returned as is, several frames in one read are returned as memoryview slices of the read,
+    # only incomplete reads are kept until the rest of the frame arrives.
+    # The data may be a view of a read buffer which is reused after feed(), the frames are only
+    # valid until then, the kept incomplete data is copied.
+    START   = 0x68
+    END     = 0x16
+    MIN_LEN = 8
+    # the largest known frame is 6803d6 (982 bytes), a longer length is a corrupt header
+    MAX_LEN = 0x3d6
+
+    def __init__(self, data_type='', logger=None):
+        self._data_type = data_type
+        self._log       = log('EnverFrame') if logger is None else logger
+        self._chunks    = []
+        self._pending   = 0
+        self._need      = 0
+
+    def __repr__(self):
+        return f'EnverFrameParser({self._data_type}, pending {self._pending})'
+
+    def pending(self):
+        return self._pending
+
+    def feed(self, data):
+        if self._chunks:
+            self._chunks.append(bytes(data))
+            self._pending += len(data)
+            if self._pending < self._need:
+                return []
+            data = b''.join(self._chunks)
+            self._chunks.clear()
+            self._pending = 0
+        frames = []
+        view = memoryview(data)
+        end = len(data)
+        pos = 0
+        while pos < end:
+            if data[pos] != self.START:
+                pos = self.resync(data, pos, end)
+                continue
+            if end - pos < 4:
+                self._need = 4
+                break
+            length = data[pos + 1] << 8 | data[pos + 2]
+            if data[pos + 3] != self.START or not self.MIN_LEN <= length <= self.MAX_LEN:
+                pos = self.resync(data, pos + 1, end, 1)
+                continue
+            if end - pos < length:
+                self._need = length
+                break
+            if data[pos + length - 1] != self.END:
+                pos = self.resync(data, pos + 1, end, 1)
+                continue
+            if pos == 0 and length == end:
+                frames.append(data)
+            else:
+                frames.append(view[pos:pos + length])
+            pos += length
+        if pos < end:
+            self._chunks.append(bytes(view[pos:]))
+            self._pending = end - pos
+        return frames
+
+    def resync(self, data, pos, end, dropped=0):
+        # skip to the next possible frame start, data is searched in place (a memoryview has no find)
+        if isinstance(data, memoryview):
+            nxt = pos
+            while nxt < end and data[nxt] != self.START:
+                nxt += 1
+        else:
+            nxt = data.find(self.START, pos, end)
+            if nxt < 0:
+                nxt = end
+        dropped += nxt - pos
+        self._log.logMsg(f'dropped {dropped} bytes of unframed {self._data_type}data', log.WARN)
+        return nxt
@@ -0,0 +1,200 @@
+
+import time
+from log import log
+
+# 6 byte command header of each known message
+CMD_POLL         = bytes.fromhex('680030681006')
+CMD_WRID_ACK     = bytes.fromhex('680030681010')
+CMD_MON_DATA     = bytes.fromhex('6803d6681004')
+CMD_BRIDGE_CMD   = bytes.fromhex('680030681007')
+CMD_SET_WRIDS    = bytes.fromhex('680020681009')
+CMD_SERVER_DATE  = bytes.fromhex('680020681027')
+CMD_SERVER_ACK   = bytes.fromhex('680012681015')
+CMD_SERVER_TIME  = bytes.fromhex('68001e681070')
+
+
+class MessageHandler:
+    # Base class for the handling of one message type.
+    # Subclasses set cmd, data_type ('client' or 'server') and name and implement handle(),
+    # handle() returns the data to forward (usually unchanged).
+    # Each handler counts its messages and the time spent in handle().
+    cmd       = b''
+    data_type = 'client'
+    name      = ''
+
+    def __init__(self):
+        self.count      = 0
+        self.bytes      = 0
+        self.time_total = 0.0
+        self.time_max   = 0.0
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.data_type}, {self.cmd.hex()})'
+
+    def dispatch(self, proxy, data):
+        start = time.perf_counter()
+        data = self.handle(proxy, data)
+        duration = time.perf_counter() - start
+        self.count      += 1
+        self.bytes      += len(data)
+        self.time_total += duration
+        if duration > self.time_max:
+            self.time_max = duration
+        return data
+
+    def handle(self, proxy, data):
+        return data
+
+    def stats(self):
+        return {'count'    : self.count,
+                'bytes'    : self.bytes,
+                'time_avg' : self.time_total / (self.count or 1),
+                'time_max' : self.time_max}
+
+
+class HandlerRegistry:
+    # message handlers keyed on data type and the raw 6 byte command header
+    def __init__(self):
+        self._handlers = {'client' : {}, 'server' : {}}
+
+    def register(self, handler):
+        # a handler for an already known command replaces the previous one
+        self._handlers[handler.data_type][handler.cmd] = handler
+
+    def unregister(self, data_type, cmd):
+        return self._handlers[data_type].pop(cmd, None)
+
+    def lookup(self, data_type, data):
+        return self._handlers[data_type].get(bytes(data[:6]))
+
+    def handlers(self):
+        return [h for d in self._handlers.values() for h in d.values()]
+
+    def stats(self):
+        return {f'{h.data_type}/{h.name}' : h.stats() for h in self.handlers()}
+
+
+class PollHandler(MessageHandler):
+    cmd  = CMD_POLL
+    name = 'poll'
+
+    def handle(self, proxy, data):
+        if proxy._log_hex:
+            proxy._log.logMsg(lambda: f'ClientPoll as hex: {data[10:].hex()}', log.INFO)
+        return data
+
+
+class WridAckHandler(MessageHandler):
+    cmd  = CMD_WRID_ACK
+    name = 'wrid_ack'
+
+    def handle(self, proxy, data):
+        proxy._log.logMsg('ClientWridAck', log.INFO)
+        if proxy._log_hex:
+            proxy._log.logMsg(lambda: f'ClientAck as hex: {data[10:].hex()}', log.INFO)
+        return data
+
+
+class MonDataHandler(MessageHandler):
+    # payload from converter
+    cmd  = CMD_MON_DATA
+    name = 'mon_data'
+
+    def handle(self, proxy, data):
+        if proxy._log_hex and proxy._log.enabled(log.INFO):
+            # count filled inverter blocks
+            p = 2
+            zerocount = 0
+            while int.from_bytes(data[-(p+32):-p], 'big') == 0:
+                zerocount += 1
+                p += 32
+            proxy._log.logMsg(f'ClientMonData as hex: {data[10:-p].hex()} {zerocount} empty {data[-2:].hex()}', log.INFO)
+        proxy.process_data(data[20:-2], bytes(data[6:10]))
+        return data
+
+
+class BridgeCmdHandler(MessageHandler):
+    # on remote brigge command
+    # -------------------------------------------------------------------------------------------
+    # cmd          account  ?id?     ?    ?    ?    ?    wrid stat dc   cmd  totalkWh temp ac   freq ?            crc?
+    # -------------------------------------------------------------------------------------------
+    # 680030681007 yyyyyyyy 00000000 0200 0010 0223 0002 1870 3021 28b8 1103 00006a6e 1ee6 3a80 3204 000000000000 5816
+    # cmd 1103  -> reboot?
+    cmd       = CMD_BRIDGE_CMD
+    data_type = 'server'
+    name      = 'bridge_cmd'
+
+    def handle(self, proxy, data):
+        if proxy._log_hex:
+            proxy._log.logMsg(lambda: f'Bridgecmd hex: {data[10:].hex()}', log.INFO)
+        proxy._log.logMsg(lambda: f'Bridgecmd {data[28:30].hex()}', log.INFO)
+        return data
+
+
+class SetWridsHandler(MessageHandler):
+    # -------------------------------------------------------------------------------------------
+    # cmd          account  ?        ?            wrid 1   wrid 2   wrid 3   crc?
+    # -------------------------------------------------------------------------------------------
+    # 680020681009 yyyyyyyy 00000000 000000000000 wwwwwwww wwwwwwww wwwwwwww 0a16
+    cmd       = CMD_SET_WRIDS
+    data_type = 'server'
+    name      = 'set_wrids'
+
+    def handle(self, proxy, data):
+        if proxy._log_hex:
+            proxy._log.logMsg(lambda: f'ServerSetWrids hex: {data[10:].hex()}', log.INFO)
+        proxy._log.logMsg(lambda: f'ServerSetWrids {data[20:-2].hex()}', log.INFO)
+        return data
+
+
+class ServerDateHandler(MessageHandler):
+    # -------------------------------------------------------------------------------------------
+    # cmd          account  power    date                                        crc?
+    # -------------------------------------------------------------------------------------------
+    # 680020681027 yyyyyyyy 00000345 HHMMmmdd 0000 0000 0000 0000 0000 0000 0000 xx16
+    cmd       = CMD_SERVER_DATE
+    data_type = 'server'
+    name      = 'server_date'
+
+    def handle(self, proxy, data):
+        if proxy._log_hex:
+            proxy._log.logMsg(lambda: f'Serverdate hex: {data[10:].hex()}', log.INFO)
+        proxy._log.logMsg(lambda: f'Serverdate {data[17]:02d}.{data[16]:02d}. {data[14]:02d}:{data[15]:02d} [{int.from_bytes(data[10:14],"big")/100:.2f}kWh] remain {data[18:32].hex()}', log.INFO)
+        return data
+
+
+class ServerAckHandler(MessageHandler):
+    # -------------------------------------------------------------------------------------------
+    # cmd          account  ?id?          crc?
+    # -------------------------------------------------------------------------------------------
+    # 680012681015 yyyyyyyy 1402070d 0000 a116
+    cmd       = CMD_SERVER_ACK
+    data_type = 'server'
+    name      = 'server_ack'
+
+    def handle(self, proxy, data):
+        if proxy._log_hex:
+            proxy._log.logMsg(lambda: f'Serverack hex: {data[10:].hex()}', log.INFO)
+        proxy._server_ack[bytes(data[6:10])] = bytes(data)
+        proxy._log.logMsg(lambda: f'Server ack {data[10:16].hex()}', log.INFO)
+        return data
+
+
+class ServerTimeHandler(MessageHandler):
+    # -------------------------------------------------------------------------------------------
+    # cmd          account  power    ?  date                                crc?
+    # -------------------------------------------------------------------------------------------
+    # 68001e681070 yyyyyyyy 00000000 7a mmddHHMMSS 0000 0000 0000 0000 0000 xx16
+    cmd       = CMD_SERVER_TIME
+    data_type = 'server'
+    name      = 'server_time'
+
+    def handle(self, proxy, data):
+        if proxy._log_hex:
+            proxy._log.logMsg(lambda: f'Servertime hex: {data[10:].hex()}', log.INFO)
+        proxy._log.logMsg(lambda: f'Servertime(China) {data[16]:02d}.{data[15]:02d}. {data[17]:02d}:{data[18]:02d}:{data[19]:02d} {data[14]:02x}({data[14]}) remain {data[10:14].hex()} {data[20:30].hex()}', log.INFO)
+        return data
+
+
+DEFAULT_HANDLERS = (PollHandler, WridAckHandler, MonDataHandler, BridgeCmdHandler,
+                    SetWridsHandler, ServerDateHandler, ServerAckHandler, ServerTimeHandler)
@@ -0,0 +1,52 @@
+
+import time
+from enverhandlers import CMD_POLL, CMD_WRID_ACK, CMD_BRIDGE_CMD, CMD_SET_WRIDS, CMD_SERVER_ACK
+
+
+class PollResponder:
+    # Answers the polls and wrid acks of the bridges locally, per bridge and message type
+    # only one is forwarded to the portal every interval seconds, the others get the answer
+    # the portal gave to the last forwarded one. Until the portal answered, all are forwarded.
+    # Data frames and the commands of the portal pass through unchanged.
+    LOCAL    = (CMD_POLL, CMD_WRID_ACK)
+    # portal frames which do not answer a poll: the commands to the bridge (never replayed)
+    # and the acks of data frames
+    COMMANDS = (CMD_BRIDGE_CMD, CMD_SET_WRIDS, CMD_SERVER_ACK)
+
+    def __init__(self, interval=300):
+        self._interval = interval
+        # (account, cmd) -> [time of the last forward, answer of the portal or None]
+        self._state    = {}
+        # account -> (account, cmd) of the last forwarded poll, the next portal answer is its one,
+        # a poll the portal did not answer is dropped when the next one is forwarded
+        self._pending  = {}
+
+    def __repr__(self):
+        return f'PollResponder({len(self._state)} polls, {self._interval})'
+
+    def local(self, data, now=None):
+        # None if the client frame is forwarded, else the answer for the bridge
+        cmd = bytes(data[:6])
+        if cmd not in self.LOCAL:
+            return None
+        if now is None:
+            now = time.monotonic()
+        account = bytes(data[6:10])
+        key = (account, cmd)
+        state = self._state.get(key)
+        if state is None or state[1] is None or now - state[0] >= self._interval:
+            if state is None:
+                self._state[key] = [now, None]
+            else:
+                state[0] = now
+            self._pending[account] = key
+            return None
+        return state[1]
+
+    def answer(self, data):
+        # a portal frame, kept if it answers a forwarded poll
+        if bytes(data[:6]) in self.COMMANDS:
+            return
+        key = self._pending.pop(bytes(data[6:10]), None)
+        if key is not None:
+            self._state[key][1] = bytes(data)
@@ -2,26 +2,106 @@
 
 import sys
 import os
+import time
 from iotproxy import TCPProxy
+from enverframe import EnverFrameParser
+from sinkqueue import SinkQueue
+from enverdecode import DECODERS, load_numpy
+from enverhandlers import HandlerRegistry, DEFAULT_HANDLERS, CMD_MON_DATA
+from enverstate import StateCache
+from enverpoll import PollResponder
+from capture import CaptureWriter
+from enverstore import StoreWriter, energy_today
+from enveraggregate import Aggregator
+from metrics import Metrics
+from supervisor import Supervisor, answer_metrics
+from resolver import PortalResolver
+from spool import Spool
 from log import log
 import configparser
 import signal
-import DNS
-import json
+import threading
+import ast
+import functools
 import argparse
-try:
-    import paho.mqtt.client as mqtt
-except:
-    mqtt = False
-try:
-    from FHEM import FHEM
-except:
-    FHEM = False
+import sinks
 
 class Enverproxy:
+    # settings which are only applied by a restart, all others are changed in place on SIGHUP
+    RESTART_SETTINGS = ('listen', 'workers', 'store', 'capture', 'metrics', 'stats_interval')
+    # capture file written out every n seconds
+    CAPTURE_FLUSH = 10
+    # seconds between the checks for heartbeats and the flush of the sinks
+    HEARTBEAT_CHECK = 10
+    SINK_FLUSH      = 10
+    # a sink is replaced on reload if its section or one of these settings changed
+    SINK_SETTINGS = ('queue', 'spool', 'aggregate')
+    # config sections which are no sinks, see sinks.py
+    SECTIONS = ('enverproxy', 'log', 'aggregate', 'metrics')
 
-    def __init__(self, configfile, logger):
+    def __init__(self, configfile, logger, worker=None):
+        # worker: index of a worker process of the supervisor, it only runs the proxy
         self._log = log('Enverproxy') if logger is None else logger
+        self._configfile = configfile
+        self._settings = settings = self.read_config(configfile)
+        self._decode  = DECODERS[settings['decoder']]
+        # publish only changed values, see enverstate.StateCache
+        self._state = self.create_state(settings['publish_changes'])
+        # local store of all decoded records, see enverstore.py
+        self._store = False
+        if settings['store'] and worker is None:
+            self._store = StoreWriter(*settings['store'])
+        log_level, self._log_hex, log_type, log_address, log_port = settings['log']
+        if log_type != 'syslog':
+            self._log.logMsg(f'set log to {log_type} {log_level}', log.INFO)
+        self._log   = log('EnverProxy', log_level, log_type, log_address, log_port)
+        self._resolver = self.create_resolver(settings['portal'])
+        listen_ip, listen_port, self._listen_backlog = settings['listen']
+        self._listen  = (listen_ip, listen_port, self.forward_addresses(settings['portal']), settings['forward'][0])
+        self._forward = settings['forward'][1:]
+        # last server ack per bridge account, replayed if the portal is not reachable
+        self._server_ack = {}
+        self._polls = self.create_polls(settings['local_polls'])
+        # rolling stats per inverter, bridge and site, published as one message per frame
+        self._aggregator  = False
+        if settings['aggregate'] and worker is None:
+            self._aggregator = self.create_aggregator(settings['aggregate'][0])
+        # one queue per sink, drained by its own workers, the records of a worker process
+        # are published by the supervisor
+        self.set_sinks({name : self.create_sinks(name, settings) for name in settings['sinks']} if worker is None else {})
+        self._reload_lock = threading.Lock()
+        self._handlers = HandlerRegistry()
+        for handler in DEFAULT_HANDLERS:
+            self._handlers.register(handler())
+        self._metrics_address = settings['metrics']
+        self._capture = False
+        self._capture_file = settings['capture']
+        self._iotserver  = None
+        self._supervisor = None
+        # queue to the supervisor in a worker process
+        self._records    = None
+        if worker is not None:
+            self.create_server(reuse_port=True, capture_file=f'{self._capture_file}.{worker}' if self._capture_file else '')
+            return
+        if settings['workers'] > 1:
+            # the proxy runs in the worker processes, this one publishes and serves the metrics
+            self._metrics = Metrics(self._log)
+            self._supervisor = Supervisor(functools.partial(run_worker, configfile), settings['workers'],
+                                          self.publish_worker_records, self._log, self._metrics, self.start_reload)
+        else:
+            self.create_server()
+        self._metrics.add_collector(self.collect_sink_metrics)
+        # the publishing side: the proxy loop, or the records thread of the supervisor
+        timers = self._iotserver if self._supervisor is None else self._supervisor
+        timers.call_every(self.HEARTBEAT_CHECK, self.heartbeat)
+        timers.call_every(self.SINK_FLUSH, self.flush_sinks)
+        if self._store:
+            # without new records the buffered ones would wait for the next frame
+            timers.call_every(settings['store'][1], self._store.flush)
+
+    def read_config(self, configfile):
+        # parse and check the whole config file, returns the settings per part,
+        # raises ValueError on errors, so a reload takes all or nothing of a file
         config = configparser.ConfigParser()
         section = 'enverproxy'
         if os.path.isfile(configfile):
@@ -40,219 +120,524 @@ class Enverproxy:
             self._log.logMsg(f'Configuration file {configfile} not found', log.CRITICAL)
             raise ValueError
         # Process configuration data
-        forward_ip = False
-        if 'portal' in config[section]:
-            portal     = config[section]['portal']
-            dns_server = config.get(section, 'dns_server', fallback= '8.8.8.8')
-        if portal != '' and dns_server != '':
-            retries = 0
-            d = DNS.DnsRequest(server=dns_server, timeout=3)
-            while forward_ip == False and retries < 3:
-                try:
-                    r=d.req(name=portal,qtype='A')
-                    if len(r.answers) < 1:
-                        self._log.logMsg('dns record empty', log.WARN)
-                    else:
-                        self._log.logMsg(f"got IP {r.answers[0]['data']}", log.DEBUG)
-                        forward_ip = r.answers[0]['data']
-                        break
-                except DNS.Error:
-                    self._log.logMsg(f'dns lookup failed ({retries})', log.INFO)
-                retries += 1
-        if forward_ip == False:
-            self._log.logMsg('dns lookup failed, using fallback', log.WARN)
-            if not 'forward_ip' in config[section]:
-                self._log.logMsg(f'forward_ip not in found in file {configfile}', log.CRITICAL)
-                raise ValueError
-            forward_ip = config[section]['forward_ip']
-        else:
-            self._log.logMsg(f'using {forward_ip} for portal access', log.INFO)
-        listen_ip   = config.get(section, 'listen_ip', fallback='')
+        settings = {}
         listen_port = int(config[section]['listen_port'])
-        forward_port = int(config.get(section, 'forward_port', fallback= listen_port))
-        forward_timeout = int(config.get(section, 'forward_timeout', fallback= 10))
+        settings['listen'] = (config.get(section, 'listen_ip', fallback=''), listen_port,
+                              int(config.get(section, 'listen_backlog', fallback= 128)))
+        settings['workers'] = int(config.get(section, 'workers', fallback= 1))
+        # the portal name is looked up in the background, see resolver.py
+        settings['portal'] = (config.get(section, 'portal', fallback= ''),
+                              config.get(section, 'dns_server', fallback= '8.8.8.8'),
+                              config.get(section, 'dns_cache', fallback= ''),
+                              config[section]['forward_ip'])
+        settings['forward'] = (int(config.get(section, 'forward_port', fallback= listen_port)),
+                               int(config.get(section, 'forward_timeout', fallback= 10)),
+                               int(config.get(section, 'forward_backoff', fallback= 5)),
+                               int(config.get(section, 'forward_backoff_max', fallback= 300)))
+        # answer polls locally, forward one per bridge every poll_interval seconds
+        settings['local_polls'] = None
+        if config.get(section, 'local_polls', fallback= 'False') == 'True':
+            settings['local_polls'] = int(config.get(section, 'poll_interval', fallback= 300))
+        settings['idle_timeout'] = int(config.get(section, 'idle_timeout', fallback= 600))
+        settings['stats_interval'] = int(config.get(section, 'stats_interval', fallback= 3600))
+        queue_policy = config.get(section, 'queue_policy', fallback= SinkQueue.DROP_OLDEST)
+        if queue_policy not in SinkQueue.POLICIES:
+            self._log.logMsg(f'unknown queue_policy {queue_policy} in config file {configfile}', log.CRITICAL)
+            raise ValueError
+        settings['queue'] = (int(config.get(section, 'queue_size', fallback= 1000)), queue_policy,
+                             int(config.get(section, 'queue_workers', fallback= 1)))
+        settings['spool'] = None
+        if config.get(section, 'spool', fallback= ''):
+            spool_policy = config.get(section, 'spool_policy', fallback= Spool.DROP_OLDEST)
+            if spool_policy not in Spool.POLICIES:
+                self._log.logMsg(f'unknown spool_policy {spool_policy} in config file {configfile}', log.CRITICAL)
+                raise ValueError
+            settings['spool'] = (config.get(section, 'spool'),
+                                 int(config.get(section, 'spool_size', fallback= 64)) << 20,
+                                 float(config.get(section, 'spool_sync', fallback= 1)),
+                                 spool_policy,
+                                 int(config.get(section, 'spool_rate', fallback= 100)))
+        settings['decoder'] = config.get(section, 'decoder', fallback= 'struct')
+        if settings['decoder'] not in DECODERS:
+            self._log.logMsg(f"decoder {settings['decoder']} from config file {configfile} is not available", log.CRITICAL)
+            raise ValueError
+        if settings['decoder'] == 'numpy':
+            # imported now, not on the first frame
+            load_numpy()
+        settings['publish_changes'] = None
+        if config.get(section, 'publish_changes', fallback= 'False') == 'True':
+            try:
+                deadbands = ast.literal_eval(config.get(section, 'deadbands', fallback= '{}'))
+            except (ValueError, SyntaxError):
+                deadbands = None
+            if not isinstance(deadbands, dict):
+                self._log.logMsg(f'deadbands in section {section} is no dictionary', log.CRITICAL)
+                raise ValueError
+            settings['publish_changes'] = (deadbands, int(config.get(section, 'heartbeat', fallback= 300)))
+        settings['store'] = None
+        if config.get(section, 'store', fallback= ''):
+            settings['store'] = (config.get(section, 'store'), int(config.get(section, 'store_flush', fallback= 10)))
+        settings['capture'] = config.get(section, 'capture', fallback= '')
         section = 'log'
         log_level   = config.get(section, 'log_level', fallback= log.WARN)
-        self._log_hex = False
-        if log_level == '4.5':
-            self._log_hex = True
+        log_hex     = log_level == '4.5'
         log_level   = int(float(log_level))
         log_type    = config.get(section, 'log_type', fallback= 'sys.stdout')
+        if log_type not in ('stdout', 'stderr', 'syslog'):
+            self._log.logMsg(f'unknown log_type {log_type} in config file {configfile}', log.CRITICAL)
+            raise ValueError
         if log_type == 'syslog':
-            log_address = config.get(section, 'log_address', fallback= '127.0.0.1')
-            log_port    = int(config.get(section, 'log_port', fallback= 514))
-            self._log   = log('EnverProxy', log_level, log_type, log_address, log_port)
+            settings['log'] = (log_level, log_hex, log_type, config.get(section, 'log_address', fallback= '127.0.0.1'),
+                               int(config.get(section, 'log_port', fallback= 514)))
         else:
-            self._log.logMsg(f'set log to {log_type} {log_level}', log.INFO)
-            self._log   = log('EnverProxy', log_level, log_type)
-        self._iotserver = TCPProxy(listen_ip, listen_port, forward_ip, forward_port, self._log)
-        self._iotserver.set_forward_timeout(forward_timeout)
-        if 'mqtt' in config:
-            section = 'mqtt'
-            mqtt_host = config.get(section, 'host', fallback= 'localhost')
-            mqtt_port = int(config.get(section, 'port', fallback= 1883))
-            self._send_json = config.get(section, 'send_json', fallback= False) == 'True'
-            self._log.logMsg(f'Starting mqtt client to {mqtt_host}:{mqtt_port}', log.INFO)
-            self._mqtt_client = mqtt.Client()
-            self._mqtt_client.connect(mqtt_host, mqtt_port)
-            self._mqtt_client.loop_start()
-            self._mqtt_topic = config.get(section, 'base_topic', fallback= 'enverproxy')
-        self._fhem_url = False
-        if 'fhem' in config:
-            if not FHEM:
-                self._log.logMsg('FHEM module not loaded', log.CRITICAL)
+            settings['log'] = (log_level, log_hex, log_type, '/dev/log', 514)
+        # {section : (sink class, settings)}
+        settings['sinks'] = {}
+        for section in config.sections():
+            if section in self.SECTIONS:
+                continue
+            try:
+                sink = sinks.find(section)
+            except ImportError as e:
+                self._log.logMsg(f'sink {section} is not available: {e}', log.CRITICAL)
+                raise ValueError
+            if sink is None:
+                self._log.logMsg(f'unknown section {section} in config file {configfile} ignored', log.WARN)
+                continue
+            try:
+                settings['sinks'][section] = (sink, sink.read_settings(config[section]))
+            except ValueError as e:
+                self._log.logMsg(f'section {section}: {e}', log.CRITICAL)
+                raise
+        settings['aggregate'] = None
+        if 'aggregate' in config:
+            section = 'aggregate'
+            if not any(sink.rollups for sink, _ in settings['sinks'].values()):
+                self._log.logMsg(f'section {section} needs a sink for the rollups (mqtt or file)', log.CRITICAL)
                 raise ValueError
-            section = 'fhem'
-            fhem_host = config.get(section, 'host', fallback= 'localhost')
-            protocol = config.get(section, 'protocol', fallback= 'https')
-            fhem_port     = int(config.get(section, 'port', fallback= 8083))
-            self._log.logMsg('Starting FHEM client', log.INFO)
-            self._fhem_url  = f"{protocol}://{fhem_host}:{fhem_port}/fhem?"
-            self._user      = config.get(section, 'user', fallback= '')
-            self._password  = config.get(section, 'password', fallback= '')
-            self._id2device = config.get(section, 'id2device', fallback= 'noconf')
+            try:
+                windows = tuple(int(w) for w in config.get(section, 'windows', fallback= '300, 900, 3600').split(','))
+                if min(windows) <= 0:
+                    raise ValueError
+            except ValueError:
+                self._log.logMsg(f'windows in section {section} is no list of seconds > 0', log.CRITICAL)
+                raise ValueError
+            settings['aggregate'] = (windows, config.get(section, 'topic', fallback= 'rollup'))
+        settings['metrics'] = None
+        if 'metrics' in config:
+            section = 'metrics'
+            settings['metrics'] = (config.get(section, 'listen_ip', fallback= '127.0.0.1'),
+                                   int(config.get(section, 'port', fallback= 9101)))
+        return settings
+
+    def create_state(self, publish_changes):
+        if not publish_changes:
+            return False
+        return StateCache(*publish_changes)
+
+    def create_polls(self, interval):
+        if interval is None:
+            return None
+        return PollResponder(interval)
+
+    def create_aggregator(self, windows):
+        aggregator = Aggregator(windows)
+        if self._store:
+            # the energy since midnight before the start is in the store, records not yet
+            # written count with the next frame, from the last stored counter on
+            aggregator.seed(energy_today(self._settings['store'][0]))
+        return aggregator
+
+    def create_resolver(self, portal_settings):
+        portal, dns_server, dns_cache, forward_ip = portal_settings
+        if portal == '' or dns_server == '':
+            return False
+        return PortalResolver(portal, dns_server, dns_cache, [forward_ip], self._log)
+
+    def forward_addresses(self, portal_settings):
+        forward_ip = self._resolver.addresses() if self._resolver else portal_settings[3]
+        self._log.logMsg(f'using {forward_ip} for portal access', log.INFO)
+        return forward_ip
+
+    def create_sinks(self, name, settings):
+        # the sink of a config section and its queues: (queue, rollup queue, sink),
+        # None if the section is not configured, the queues are not started
+        if name not in settings['sinks']:
+            return None
+        queue_size, queue_policy, queue_workers = settings['queue']
+        cls, sink_settings = settings['sinks'][name]
+        # the spool directories are checked before the sink connects, raises OSError
+        spool_args = self.spool_args(name, settings)
+        rollup_spool_args = self.spool_args(f'{name}-rollup', settings)
+        sink = cls(name, sink_settings, self._log, queue_workers)
+        if sink.records == 'frame':
+            queue = SinkQueue(name, sink.publish, queue_size, queue_policy, queue_workers, self._log,
+                              key=lambda frame: frame['bridge'], merge=self.merge_frames, **spool_args)
+        else:
+            queue = SinkQueue(name, sink.publish, queue_size, queue_policy, queue_workers, self._log,
+                              batch=sink.batch if sink.records == 'batch' else 1, **spool_args)
+        rollup_queue = None
+        if settings['aggregate'] and sink.rollups:
+            topic = settings['aggregate'][1]
+            rollup_queue = SinkQueue(f'{name}-rollup', lambda rollup: sink.publish_rollup(rollup, topic),
+                                     queue_size, queue_policy, 1, self._log, key=lambda rollup: rollup['bridge'],
+                                     **rollup_spool_args)
+        return (queue, rollup_queue, sink)
+
+    @staticmethod
+    def merge_frames(old, frame):
+        # a frame coalesced with a queued one of the same bridge keeps the records of both,
+        # merged per wrid (with publish_changes a record only holds the changed fields)
+        records = {record['wrid'] : record for record in old['records']}
+        for record in frame['records']:
+            records[record['wrid']] = {**records.get(record['wrid'], {}), **record}
+        return {**frame, 'records' : list(records.values())}
+
+    def spool_args(self, name, settings):
+        # a spool directory per sink, records which could not be published are kept there
+        if not settings['spool']:
+            return {}
+        directory, max_bytes, sync_interval, policy, rate = settings['spool']
+        spool = Spool(os.path.join(directory, name), max_bytes, sync_interval=sync_interval,
+                      policy=policy, logger=self._log)
+        spool.check()
+        return {'spool' : spool, 'replay_rate' : rate}
+
+    def close_sinks(self, group):
+        # stops the queues of a sink after they published what is queued
+        queue, rollup_queue, sink = group
+        for q in (queue, rollup_queue):
+            if q:
+                q.stop()
+                self._log.logMsg(f'{q.name} queue stats {q.stats()}', log.INFO)
+        sink.close()
+
+    def set_sinks(self, groups):
+        # publish_data and publish_records run on other threads, they see the old or the new lists
+        self._sink_groups = groups
+        self._sinks = [g[0] for g in groups.values() if g and g[2].records != 'frame']
+        self._frame_sinks = [g[0] for g in groups.values() if g and g[2].records == 'frame']
+        self._rollup_sinks = [g[1] for g in groups.values() if g and g[1]]
+
+    def start_reload(self):
+        # SIGHUP: the reload waits for the replaced sinks to drain, so it runs beside the proxy loop
+        threading.Thread(target=self.reload, name='reload', daemon=True).start()
+
+    def reload(self):
+        # reads the config file again and applies the changes in place, bridge connections are kept,
+        # new forward settings are used for the next portal connects.
+        # a config with errors (or a sink which can not be connected) changes nothing
+        if not self._reload_lock.acquire(blocking=False):
+            self._log.logMsg('reload already running', log.WARN)
+            return False
+        try:
+            try:
+                settings = self.read_config(self._configfile)
+            except (ValueError, configparser.Error) as e:
+                self._log.logMsg(f'config {self._configfile} not reloaded: {e!r}', log.ERROR)
+                return False
+            changed = [key for key in settings if settings[key] != self._settings[key]]
+            if not changed:
+                self._log.logMsg(f'config {self._configfile} unchanged', log.INFO)
+                return True
+            groups = dict(self._sink_groups)
+            if self._records is None:
+                # in a worker process the records are published by the supervisor
+                old = self._settings['sinks']
+                replaced = [name for name in set(old) | set(settings['sinks'])
+                            if old.get(name) != settings['sinks'].get(name) or any(k in changed for k in self.SINK_SETTINGS)]
+                try:
+                    for name in replaced:
+                        groups[name] = self.create_sinks(name, settings)
+                except OSError as e:
+                    self._log.logMsg(f'config {self._configfile} not reloaded, sink failed: {e!r}', log.ERROR)
+                    for name in replaced:
+                        if groups[name] is not self._sink_groups.get(name) and groups[name]:
+                            self.close_sinks(groups[name])
+                    return False
+            self.apply_settings(settings, changed, groups)
+            self._log.logMsg(f'config {self._configfile} reloaded, changed {changed}', log.INFO)
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def apply_settings(self, settings, changed, groups):
+        for key in changed:
+            if key in self.RESTART_SETTINGS:
+                self._log.logMsg(f'{key} settings changed, applied on restart', log.WARN)
+        if 'log' in changed:
+            log_level, self._log_hex, log_type, log_address, log_port = settings['log']
+            self._log.configure(log_level, log_type, log_address, log_port)
+        if 'decoder' in changed:
+            self._decode = DECODERS[settings['decoder']]
+        if 'publish_changes' in changed:
+            self._state = self.create_state(settings['publish_changes'])
+        if 'portal' in changed:
+            if self._resolver:
+                self._resolver.stop()
+            self._resolver = self.create_resolver(settings['portal'])
+            self._listen = self._listen[:2] + (self.forward_addresses(settings['portal']),) + self._listen[3:]
+            if self._iotserver is not None:
+                self._iotserver.set_forward_addresses(self._listen[2])
+                if self._resolver:
+                    self._resolver.add_listener(self._iotserver.set_forward_addresses)
+                    self._resolver.start()
+        if 'forward' in changed:
+            self._listen = self._listen[:3] + (settings['forward'][0],)
+            self._forward = settings['forward'][1:]
+            if self._iotserver is not None:
+                self._iotserver.set_forward_port(settings['forward'][0])
+                self._iotserver.set_forward_timeout(self._forward[0])
+                self._iotserver.set_forward_backoff(*self._forward[1:])
+        if 'local_polls' in changed:
+            self._polls = self.create_polls(settings['local_polls'])
+            if self._iotserver is not None:
+                self._iotserver.set_local_first(self._polls.local if self._polls else None)
+        if 'idle_timeout' in changed and self._iotserver is not None:
+            self._iotserver.set_idle_timeout(settings['idle_timeout'])
+        if 'aggregate' in changed:
+            # the running stats are kept if only the topic changed
+            windows = settings['aggregate'][0] if settings['aggregate'] else None
+            if not windows:
+                self._aggregator = False
+            elif not self._aggregator:
+                self._aggregator = self.create_aggregator(windows)
+            elif windows != self._settings['aggregate'][0]:
+                # the energy of today is kept
+                self._aggregator.set_windows(windows)
+        old = self._sink_groups
+        self.set_sinks(groups)
+        for name, group in groups.items():
+            if group is not old.get(name):
+                # the new queues take the records while the old ones drain, then they are started
+                if old.get(name):
+                    self.close_sinks(old[name])
+                if group:
+                    for queue in group[:2]:
+                        if queue:
+                            queue.start()
+        self._settings = settings
+
+    def create_server(self, reuse_port=False, capture_file=None):
+        self._iotserver = TCPProxy(*self._listen, self._log, self._listen_backlog, reuse_port)
+        if self._resolver:
+            self._resolver.add_listener(self._iotserver.set_forward_addresses)
+        self._iotserver.set_forward_timeout(self._forward[0])
+        self._iotserver.set_forward_backoff(*self._forward[1:])
+        self._iotserver.set_framer(EnverFrameParser)
+        self._iotserver.set_local_responder(self.local_answer)
+        self._iotserver.set_session_key(self.session_key)
+        if self._polls:
+            self._iotserver.set_local_first(self._polls.local)
+        self._iotserver.set_reload_handler(self.start_reload)
+        self._iotserver.set_idle_timeout(self._settings['idle_timeout'])
+        if self._settings['stats_interval']:
+            self._iotserver.call_every(self._settings['stats_interval'], self.log_stats)
         self._iotserver.register_callback(self.data_cb)
+        self._metrics = self._iotserver.metrics
+        self._m_data_cb = self._metrics.histogram('enverproxy_data_cb_seconds', 'time in data_cb per frame')
+        self._m_unknown = {t : self._metrics.counter('enverproxy_unknown_messages_total', 'messages without handler', {'data_type' : t})
+                           for t in ('client', 'server')}
+        self._metrics.add_collector(self.collect_metrics)
+        capture_file = self._capture_file if capture_file is None else capture_file
+        if capture_file:
+            self._capture = CaptureWriter(capture_file)
+            self._iotserver.set_capture(self._capture)
+            self._iotserver.call_every(self.CAPTURE_FLUSH, self._capture.flush)
+
+    def run_worker(self, records, conn):
+        # the proxy of a worker process, see run_worker below
+        self._records = records
+        threading.Thread(target=answer_metrics, args=(conn, self._metrics), name='metrics', daemon=True).start()
+        # each worker looks up the portal itself
+        if self._resolver:
+            self._resolver.start()
+        try:
+            self._iotserver.loop()
+        finally:
+            if self._resolver:
+                self._resolver.stop()
+            self._log.logMsg(f'message stats {self.handler_stats()}', log.INFO)
+            if self._capture:
+                self._capture.close()
 
     def publish_data(self, values):
-        wrid = values['wrid']
-        #mqtt
-        if self._mqtt_client:
-            self._log.logMsg('sending mqtt', log.DEBUG)
-            if not self._mqtt_client.is_connected():
-                self._mqtt_client.reconnect()
-            if self._mqtt_client.is_connected():
-                if self._send_json:
-                    json_object = json.dumps(values, indent = None)
-                    topic = {self._mqtt_topic}/{wrid}
-                    self._log.logMsg(f'send {topic} :{json_object}', log.DEBUG)
-                    self._mqtt_client.publish(topic, json_object)
-                else:
-                    for key, value in values.items():
-                        if key == 'wrid':
-                            continue
-                        topic = f'{self._mqtt_topic}/{wrid}/{key}'
-                        self._log.logMsg(f'send {topic} :{value}', log.DEBUG)
-                        self._mqtt_client.publish(topic, value)
-        # Fhem
-        if self._fhem_url:
-            self._log.logMsg('sending to fhem', log.DEBUG)
-            fhem_server = FHEM(self._fhem_url, self._user, self._password, self._log)
-            if wrid in self._id2device:
-                #values = ['wrid', 'ac', 'dc', 'temp', 'power', 'totalkwh', 'freq']
-                for key, value in values.items():
-                    fhem_cmd = f'set {self._id2device[wrid]} {key} {value}'
-                    self._log.logMsg(f'fhem command: {fhem_cmd}', log.DEBUG)
-                    fhem_server.send_command(fhem_cmd)
-            else:
-                self._log.logMsg(f'No FHEM device known for converter ID {wrid}', log.WARN)
-
-    
-    def process_data(self, data):
-        # Extract information from bytearray
-        # 0        4    6    8    10       14   16   18   20                       32
-        # -------------------------------------------------------------------------------------------
-        # wrid     stat dc   pwr  totalkWh temp ac   freq rest                     next
-        # -------------------------------------------------------------------------------------------
-        # xxxxxxxx 2202 40d0 352b 001c5f39 1d66 3872 3204 0000
-        # 12881870 3021 2b64 3707 0000b276 2240 3b1d 31fd 000000000000000000000000 xxx...
-        
-        pos = 0
-        wrid = data[pos:pos+4].hex()
-        #while wrid != '00000000':
-        while pos < len(data):
-            if wrid != '00000000':
-                status = data[pos+4:pos+6].hex()
-                dc = '{0:.2f}'.format(int.from_bytes(data[pos+6:pos+8],"big") / 512)
-                power = '{0:.2f}'.format(int.from_bytes(data[pos+8:pos+10],"big") / 64)
-                total = '{0:.2f}'.format(int.from_bytes(data[pos+10:pos+14],"big") / 8192)
-                temp = '{0:.2f}'.format(int.from_bytes(data[pos+14:pos+16],"big") / 128 - 40)
-                ac = '{0:.2f}'.format(int.from_bytes(data[pos+16:pos+18],"big") / 64)
-                freq = '{0:.2f}'.format(int.from_bytes(data[pos+18:pos+20],"big") / 256)
-                remaining = data[pos+20:pos+32].hex()
-                if status == '3021':
-                    result = {'wrid' : wrid, 'status' : status, 'dc' : dc, 'power' : power, 'totalkwh' : total, 'temp' : temp, 'ac' : ac, 'freq' : freq, 'remaining' : remaining}
-                else:
-                    result = {'wrid' : wrid, 'status' : status, 'ac' : ac, 'freq' : freq, 'remaining' : remaining}
-                self._log.logMsg(result, log.INFO)
-                self.publish_data(result)
-            pos += 32
-            wrid = data[pos:pos+4].hex()
- 
+        # hand over to the sink workers, never blocks the proxy loop unless queue_policy is block
+        for sink in self._sinks:
+            sink.put(values)
+
+    def queues(self):
+        return self._sinks + self._frame_sinks + self._rollup_sinks
+
+    def sink_stats(self):
+        return {sink.name : sink.stats() for sink in self.queues()}
+
+    def process_data(self, data, account=None):
+        # data holds 32 byte blocks per inverter, see enverdecode.py
+        # account is the bridge which sent the frame
+        records = self._decode(data)
+        for record in records:
+            self._log.logMsg('%s', log.INFO, record)
+        if self._records is not None:
+            # worker process, the supervisor keeps the state and publishes, one stream per wrid
+            self._records.put((records, account))
+            return
+        self.publish_records(records, account)
+
+    def publish_worker_records(self, item):
+        self.publish_records(*item)
+
+    def publish_records(self, records, account=None):
+        # the sinks may be replaced by a reload meanwhile
+        aggregator, rollup_sinks = self._aggregator, self._rollup_sinks
+        if aggregator and rollup_sinks:
+            rollup = aggregator.update(records, account)
+            for sink in rollup_sinks:
+                sink.put(rollup)
+        published = []
+        for record in records:
+            if self._store:
+                self._store.append(record)
+            if self._state:
+                record = self._state.changes(record, bridge=account)
+                if record is None:
+                    continue
+            self.publish_data(record)
+            published.append(record)
+        if published:
+            self.publish_frame(published, account)
+
+    def publish_frame(self, records, account):
+        # one document per frame
+        frame_sinks = self._frame_sinks
+        if not frame_sinks:
+            return
+        frame = {'bridge' : '-' if account is None else account.hex(), 'timestamp' : round(time.time(), 3),
+                 'records' : records}
+        for sink in frame_sinks:
+            sink.put(frame)
+
+    def heartbeat(self):
+        # inverters without frames (i.e. at night) are published with their last values every heartbeat
+        state = self._state
+        if not state:
+            return
+        frames = {}
+        for account, record in state.due():
+            self.publish_data(record)
+            frames.setdefault(account, []).append(record)
+        for account, records in frames.items():
+            self.publish_frame(records, account)
+
+    def flush_sinks(self):
+        for group in list(self._sink_groups.values()):
+            if group:
+                group[2].flush()
+
+    def session_key(self, data):
+        # bridge account (yyyyyyyy) of a client frame
+        if len(data) < 10 or data[0] != 0x68:
+            return None
+        return bytes(data[6:10])
+
+    def local_answer(self, data):
+        # answer inverter data from the bridge if the portal is not reachable
+        if data[:6] != CMD_MON_DATA:
+            return None
+        account = bytes(data[6:10])
+        if account in self._server_ack:
+            return self._server_ack[account]
+        # 680012681015 yyyyyyyy 1402070d 0000 xx16
+        # no ack seen from the portal yet, the checksum calculation is unknown, use the byte sum
+        ack = bytes.fromhex('680012681015') + account + bytes(data[10:14]) + bytes(2)
+        return ack + bytes([sum(ack) & 0xff, 0x16])
+
+    def register_handler(self, handler):
+        # add or replace the handler for a message type, see enverhandlers.MessageHandler
+        self._handlers.register(handler)
+
+    def handler_stats(self):
+        return self._handlers.stats()
+
+    def log_stats(self):
+        self._log.logMsg(lambda: f'message stats {self.handler_stats()}', log.INFO)
+        for sink in self.queues():
+            self._log.logMsg(lambda: f'{sink.name} queue stats {sink.stats()}', log.INFO)
+
+    def collect_metrics(self):
+        handlers = self._handlers.handlers()
+        yield ('enverproxy_messages_total', 'counter', 'messages per type',
+               [({'data_type' : h.data_type, 'type' : h.name}, h.count) for h in handlers])
+        yield ('enverproxy_message_seconds_total', 'counter', 'time spent per message type',
+               [({'data_type' : h.data_type, 'type' : h.name}, h.time_total) for h in handlers])
+
+    def collect_sink_metrics(self):
+        stats = self.sink_stats()
+        for key, t, h in (('depth', 'gauge', 'records queued per sink'),
+                          ('published', 'counter', 'records published per sink'),
+                          ('dropped', 'counter', 'records dropped per sink'),
+                          ('errors', 'counter', 'failed publishes per sink'),
+                          ('publish_avg', 'gauge', 'average publish time per sink'),
+                          ('spooled', 'gauge', 'records in the spool per sink'),
+                          ('replayed', 'counter', 'spooled records published per sink'),
+                          ('evicted', 'counter', 'spooled records dropped per sink')):
+            yield (f'enverproxy_sink_{key}', t, h, [({'sink' : name}, s[key]) for name, s in stats.items()])
 
     def data_cb(self, data_type, data):
-        self._log.logMsg(f'callback for {data_type}data ({len(data)})', log.DEBUG)
+        self._log.logMsg('callback for %sdata (%d)', log.DEBUG, data_type, len(data))
+        polls = self._polls
+        if polls and data_type == 'server':
+            polls.answer(data)
+        handler = self._handlers.lookup(data_type, data)
+        if handler is not None:
+            start = time.perf_counter()
+            data = handler.dispatch(self, data)
+            self._m_data_cb.observe(time.perf_counter() - start)
+            return data
+        self._m_unknown[data_type].inc()
         if data_type == 'client':
-            
-            if data[:6].hex() == '680030681006':
-                if self._log_hex:
-                    self._log.logMsg(f'ClientPoll as hex: {data[10:].hex()}', log.INFO)
-            elif data[:6].hex() == '680030681010':
-                self._log.logMsg(f'ClientWridAck', log.INFO)
-                if self._log_hex:
-                    self._log.logMsg(f'ClientAck as hex: {data[10:].hex()}', log.INFO)
-            elif data[:6].hex() == '6803d6681004':
-                # payload from converter
-                if self._log_hex:
-                    # count filled inverter blocks
-                    p = 2
-                    zerocount = 0
-                    while int.from_bytes(data[-(p+32):-p], 'big') == 0:
-                        zerocount += 1
-                        p += 32
-                    self._log.logMsg(f'ClientMonData as hex: {data[10:-p].hex()} {zerocount} empty {data[-2:].hex()}', log.INFO)
-                self.process_data(data[20:-2])
-            else:
-                self._log.logMsg(f'Client sent message with unknown content and length {len(data)}', log.WARN)
-                self._log.logMsg(f'unknown Clientdata as hex: {data.hex()}', 3)
-        else: # server data
-            if data[:6].hex() == '680030681007': # on remote brigge command
-                # -------------------------------------------------------------------------------------------
-                # cmd          account  ?id?     ?    ?    ?    ?    wrid stat dc   cmd  totalkWh temp ac   freq ?            crc?
-                # -------------------------------------------------------------------------------------------
-                # 680030681007 yyyyyyyy 00000000 0200 0010 0223 0002 1870 3021 28b8 1103 00006a6e 1ee6 3a80 3204 000000000000 5816
-                # cmd 1103  -> reboot?
-                if self._log_hex:
-                    self._log.logMsg(f'Bridgecmd hex: {data[10:].hex()}', log.INFO)
-                self._log.logMsg(f'Bridgecmd {data[28:30].hex()}', log.INFO)
-            elif data[:6].hex() == '680020681009':
-                # -------------------------------------------------------------------------------------------
-                # cmd          account  ?        ?            wrid 1   wrid 2   wrid 3   crc?
-                # -------------------------------------------------------------------------------------------
-                # 680020681009 yyyyyyyy 00000000 000000000000 wwwwwwww wwwwwwww wwwwwwww 0a16
-                if self._log_hex:
-                    self._log.logMsg(f'ServerSetWrids hex: {data[10:].hex()}', log.INFO)
-                self._log.logMsg(f'ServerSetWrids {data[20:-2].hex()}', log.INFO)
-            elif data[:6].hex() == '680020681027':
-                # -------------------------------------------------------------------------------------------
-                # cmd          account  power    date                                        crc?
-                # -------------------------------------------------------------------------------------------
-                # 680020681027 yyyyyyyy 00000345 HHMMmmdd 0000 0000 0000 0000 0000 0000 0000 xx16
-                if self._log_hex:
-                    self._log.logMsg(f'Serverdate hex: {data[10:].hex()}', log.INFO)
-                power     = int.from_bytes(data[10:14],"big")
-                self._log.logMsg(f'Serverdate {data[17]:02d}.{data[16]:02d}. {data[14]:02d}:{data[15]:02d} [{power/100:.2f}kWh] remain {data[18:32].hex()}', log.INFO)
-            elif data[:6].hex() == '680012681015':
-                # -------------------------------------------------------------------------------------------
-                # cmd          account  ?id?          crc?
-                # -------------------------------------------------------------------------------------------
-                # 680012681015 yyyyyyyy 1402070d 0000 a116
-                if self._log_hex:
-                    self._log.logMsg(f'Serverack hex: {data[10:].hex()}', log.INFO)
-                self._log.logMsg("Server ack " + str(data[10:16].hex()), log.INFO)
-            elif data[:6].hex() == '68001e681070':
-                # -------------------------------------------------------------------------------------------
-                # cmd          account  power    ?  date                                crc?
-                # -------------------------------------------------------------------------------------------
-                # 68001e681070 yyyyyyyy 00000000 7a mmddHHMMSS 0000 0000 0000 0000 0000 xx16
-                if self._log_hex:
-                    self._log.logMsg(f'Servertime hex: {data[10:].hex()}', log.INFO)
-                self._log.logMsg(f'Servertime(China) {data[16]:02d}.{data[15]:02d}. {data[17]:02d}:{data[18]:02d}:{data[19]:02d} {data[14]:02x}({data[14]}) remain {data[10:14].hex()} {data[20:30].hex()}', log.INFO)
-            else:
-                self._log.logMsg(f'unknown Serverdata as hex: {data.hex()}', log.WARN)            
+            self._log.logMsg('Client sent message with unknown content and length %d', log.WARN, len(data))
+            self._log.logMsg(lambda: f'unknown Clientdata as hex: {data.hex()}', 3)
+        else:
+            self._log.logMsg(lambda: f'unknown Serverdata as hex: {data.hex()}', log.WARN)
         return data
 
     def run(self):
-        self._iotserver.loop()
+        for sink in self.queues():
+            sink.start()
+        if self._metrics_address:
+            self._metrics.serve(*self._metrics_address)
+        try:
+            if self._supervisor is not None:
+                self._supervisor.run()
+            else:
+                if self._resolver:
+                    self._resolver.start()
+                self._iotserver.loop()
+        finally:
+            if self._resolver:
+                self._resolver.stop()
+            for sink in self.queues():
+                sink.stop()
+                self._log.logMsg(f'{sink.name} queue stats {sink.stats()}', log.INFO)
+            if self._supervisor is None:
+                self._log.logMsg(f'message stats {self.handler_stats()}', log.INFO)
+            self._metrics.stop()
+            if self._capture:
+                self._capture.close()
+            if self._store:
+                self._store.close()
+
+def run_worker(configfile, index, records, logs, conn):
+    # a worker process of the supervisor, not forked from it (see supervisor.py),
+    # so it reads the config file itself
+    # SIGHUP would end the process until the proxy loop installs its handler, SIGINT goes to the supervisor
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the log records go to the supervisor
+    log.forward_to(logs, f'[worker {index}] ')
+    Enverproxy(configfile, log('Enverproxy'), worker=index).run_worker(records, conn)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Enverproxy')
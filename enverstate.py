@@ -0,0 +1,71 @@
+
+import time
+
+
+class StateCache:
+    # Last published values per inverter (wrid), only fields that changed by more than their
+    # deadband are published again. Each inverter is published completely at least every
+    # heartbeat seconds (0 = never).
+    # Fields missing in a record (dc, power, totalkwh, temp in standby) keep their last value,
+    # so the bad standby values are never published.
+    # due() returns the inverters without a complete publish for heartbeat seconds, so they are
+    # published on time even if no frame arrives (i.e. at night, with the last values).
+
+    def __init__(self, deadbands=None, heartbeat=300):
+        self._deadbands = {} if deadbands is None else dict(deadbands)
+        self._heartbeat = heartbeat
+        # wrid -> [time of last complete publish, {field : last published value}, bridge]
+        self._state     = {}
+
+    def __repr__(self):
+        return f'StateCache({len(self._state)} inverters, {self._deadbands}, {self._heartbeat})'
+
+    def changes(self, record, now=None, bridge=None):
+        # returns the record reduced to wrid and the changed fields, or None if nothing changed
+        if now is None:
+            now = time.monotonic()
+        wrid = record['wrid']
+        state = self._state.get(wrid)
+        if state is None or (self._heartbeat and now - state[0] >= self._heartbeat):
+            if state is None:
+                self._state[wrid] = [now, dict(record), bridge]
+            else:
+                state[0] = now
+                state[1].update(record)
+                state[2] = bridge
+            return record
+        last = state[1]
+        result = None
+        for key, value in record.items():
+            if key in last:
+                old = last[key]
+                if old == value:
+                    continue
+                band = self._deadbands.get(key)
+                if band is not None and abs(value - old) < band:
+                    continue
+            if result is None:
+                result = {'wrid' : wrid}
+            result[key] = value
+            last[key] = value
+        return result
+
+    def due(self, now=None):
+        # [(bridge, record), ...] of the inverters whose heartbeat is over, counted as published
+        if not self._heartbeat:
+            return []
+        if now is None:
+            now = time.monotonic()
+        due = []
+        for state in self._state.values():
+            if now - state[0] >= self._heartbeat:
+                state[0] = now
+                due.append((state[2], dict(state[1])))
+        return due
+
+    def last(self, wrid):
+        state = self._state.get(wrid)
+        return None if state is None else state[1]
+
+    def forget(self, wrid):
+        self._state.pop(wrid, None)
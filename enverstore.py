@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import mmap
+import math
+import struct
+import argparse
+
+# Local store of the decoded inverter records, one append-only file per day (local time)
+#
+# file header: b'ENVTS' + version (1 byte) + record size (uint16)
+# per record:  timestamp (double, unix time) wrid (uint32) status (uint16) 2 pad bytes
+#              totalkwh (double) dc power temp ac freq (float)
+# fields missing in a record (standby) are stored as NaN
+# The records of a day are appended in time order, so a day file can be searched by timestamp.
+MAGIC   = b'ENVTS'
+VERSION = 1
+HEADER  = struct.Struct('<5sBH')
+RECORD  = struct.Struct('<dIH2xd5f')
+FIELDS  = ('timestamp', 'wrid', 'status', 'totalkwh', 'dc', 'power', 'temp', 'ac', 'freq')
+VALUES  = FIELDS[3:]
+SUFFIX  = '.ets'
+NAN     = math.nan
+
+
+def day_of(timestamp):
+    return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+
+def day_end(timestamp):
+    t = time.localtime(timestamp)
+    return time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+
+class StoreWriter:
+    # Records are packed into a preallocated buffer, which is written when it is full,
+    # after flush_interval seconds or on the change of the day.
+
+    def __init__(self, directory, flush_interval=10, buffer_size=65536):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._flush_interval = flush_interval
+        self._buffer   = bytearray(max(buffer_size // RECORD.size, 1) * RECORD.size)
+        self._pos      = 0
+        self._file     = None
+        self._day_end  = 0
+        self._flush_at = 0
+        self.records   = 0
+
+    def __repr__(self):
+        return f'StoreWriter({self._directory}, {self.records} records)'
+
+    def append(self, record, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if timestamp >= self._day_end:
+            self.rotate(timestamp)
+        elif self._pos == len(self._buffer) or timestamp >= self._flush_at:
+            self.flush(timestamp)
+        get = record.get
+        RECORD.pack_into(self._buffer, self._pos, timestamp, record['wrid'], get('status', 0),
+                         get('totalkwh', NAN), get('dc', NAN), get('power', NAN),
+                         get('temp', NAN), get('ac', NAN), get('freq', NAN))
+        self._pos += RECORD.size
+        self.records += 1
+
+    def rotate(self, timestamp):
+        self.close()
+        self._file = open(os.path.join(self._directory, day_of(timestamp) + SUFFIX), 'ab', buffering=0)
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self._day_end  = day_end(timestamp)
+        self._flush_at = timestamp + self._flush_interval
+
+    def flush(self, timestamp=None):
+        if self._pos and self._file is not None:
+            self._file.write(memoryview(self._buffer)[:self._pos])
+        self._pos = 0
+        self._flush_at = (time.time() if timestamp is None else timestamp) + self._flush_interval
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+class DayFile:
+    # read access to the records of one day file through mmap
+
+    def __init__(self, path):
+        self.path   = path
+        self.count  = 0
+        self._map   = None
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                return
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f'{path} is no store file')
+        # a record being written may be incomplete
+        self.count = (size - HEADER.size) // RECORD.size
+
+    def __repr__(self):
+        return f'DayFile({self.path}, {self.count} records)'
+
+    def timestamp(self, index):
+        return struct.unpack_from('<d', self._map, HEADER.size + index * RECORD.size)[0]
+
+    def find(self, timestamp):
+        # index of the first record at or after timestamp
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def records(self, start=0, stop=None):
+        # tuples in the order of FIELDS
+        if self._map is None:
+            return
+        stop = self.count if stop is None else min(stop, self.count)
+        if start >= stop:
+            return
+        unpack_from = RECORD.unpack_from
+        for offset in range(HEADER.size + start * RECORD.size, HEADER.size + stop * RECORD.size, RECORD.size):
+            yield unpack_from(self._map, offset)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def as_dict(values):
+    record = dict(zip(FIELDS, values))
+    for key in VALUES:
+        if record[key] != record[key]:
+            # NaN, not in the record
+            del record[key]
+    return record
+
+
+def day_files(directory, first=None, last=None):
+    # paths of the day files from day first to day last ('YYYY-MM-DD'), oldest first
+    days = sorted(name[:-len(SUFFIX)] for name in os.listdir(directory) if name.endswith(SUFFIX))
+    return [os.path.join(directory, day + SUFFIX) for day in days
+            if (first is None or day >= first) and (last is None or day <= last)]
+
+
+def scan(directory, start=None, end=None, wrid=None):
+    # records with start <= timestamp < end, optionally of one inverter
+    first = None if start is None else day_of(start)
+    last  = None if end is None else day_of(end)
+    for path in day_files(directory, first, last):
+        day = DayFile(path)
+        try:
+            index = 0 if start is None else day.find(start)
+            for values in day.records(index):
+                if end is not None and values[0] >= end:
+                    break
+                if wrid is None or values[1] == wrid:
+                    yield as_dict(values)
+        finally:
+            day.close()
+
+
+def latest(directory, days=1):
+    # last record per inverter of the newest days
+    result = {}
+    for path in reversed(day_files(directory)[-days:]):
+        newest = {}
+        day = DayFile(path)
+        try:
+            for values in day.records():
+                newest[values[1]] = values
+        finally:
+            day.close()
+        for wrid, values in newest.items():
+            result.setdefault(wrid, as_dict(values))
+    return result
+
+
+def day_energy(path):
+    # kWh per inverter of a day file from the totalkwh counter and the last counter value:
+    # ({wrid : kwh}, {wrid : totalkwh})
+    # the counter may start again at 0 (i.e. after a reset of the inverter), then the new value counts
+    energy = {}
+    previous = {}
+    day = DayFile(path)
+    try:
+        for values in day.records():
+            wrid, total = values[1], values[3]
+            if total != total:
+                continue
+            last_total = previous.get(wrid)
+            if last_total is None:
+                energy[wrid] = 0.0
+            elif total >= last_total:
+                energy[wrid] += total - last_total
+            else:
+                energy[wrid] += total
+            previous[wrid] = total
+    finally:
+        day.close()
+    return energy, previous
+
+
+def daily_energy(directory, first=None, last=None):
+    # kWh per day and inverter: {day : {wrid : kwh}}
+    return {os.path.basename(path)[:-len(SUFFIX)] : day_energy(path)[0]
+            for path in day_files(directory, first, last)}
+
+
+def energy_today(directory, timestamp=None):
+    # kWh since midnight and last totalkwh per inverter: {wrid : (kwh, totalkwh)}
+    day = day_of(time.time() if timestamp is None else timestamp)
+    for path in day_files(directory, day, day):
+        energy, totals = day_energy(path)
+        return {wrid : (energy[wrid], totals[wrid]) for wrid in energy}
+    return {}
+
+
+def format_values(record):
+    line = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['timestamp'])),
+            f"{record['wrid']:08x}", f"{record['status']:04x}"]
+    line += [f'{key}={record[key]:.2f}' for key in VALUES if key in record]
+    return ' '.join(line)
+
+
+def parse_time(value):
+    return time.mktime(time.strptime(value, '%Y-%m-%d %H:%M' if ' ' in value else '%Y-%m-%d'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Enverproxy measurement store')
+    parser.add_argument('directory', help='store directory (store = ... in the config)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('scan', help='records of a time range')
+    p.add_argument('--start', type=parse_time, help="'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM'")
+    p.add_argument('--end', type=parse_time, help="'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM', not included")
+    p.add_argument('--wrid', type=lambda x: int(x, 16), help='inverter id (hex)')
+    p = sub.add_parser('latest', help='last record per inverter')
+    p.add_argument('--days', type=int, default=1, help='days to look back for inverters')
+    p = sub.add_parser('energy', help='kWh per day and inverter')
+    p.add_argument('--first', help='first day YYYY-MM-DD')
+    p.add_argument('--last', help='last day YYYY-MM-DD')
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        print(f'{args.directory} is no directory', file=sys.stderr)
+        sys.exit(1)
+    if args.command == 'scan':
+        for record in scan(args.directory, args.start, args.end, args.wrid):
+            print(format_values(record))
+    elif args.command == 'latest':
+        for wrid, record in sorted(latest(args.directory, args.days).items()):
+            print(format_values(record))
+    else:
+        for day, energy in daily_energy(args.directory, args.first, args.last).items():
+            for wrid, kwh in sorted(energy.items()):
+                print(f'{day} {wrid:08x} {kwh:.2f}kWh')
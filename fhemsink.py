@@ -0,0 +1,54 @@
+
+import ast
+from FHEM import FHEM
+from enverdecode import format_record
+from sinks import Sink
+from log import log
+
+
+class FHEMSink(Sink):
+    # sets the readings of the FHEM device of each inverter (id2device),
+    # all records taken from the queue at once (usually a whole frame) go in one request
+    records = 'batch'
+
+    @classmethod
+    def read_settings(cls, section):
+        try:
+            id2device = ast.literal_eval(section.get('id2device', '{}'))
+        except (ValueError, SyntaxError):
+            id2device = None
+        if not isinstance(id2device, dict):
+            raise ValueError('id2device in section fhem is no dictionary')
+        protocol = section.get('protocol', 'https')
+        return {'url'       : f"{protocol}://{section.get('host', 'localhost')}:{int(section.get('port', 8083))}/fhem?",
+                'user'      : section.get('user', ''),
+                'password'  : section.get('password', ''),
+                'id2device' : id2device,
+                'batch'     : int(section.get('batch', 100))}
+
+    def __init__(self, name, settings, logger=None, workers=1):
+        super().__init__(name, settings, logger, workers)
+        self._log.logMsg('Starting FHEM client', log.INFO)
+        self._id2device = settings['id2device']
+        # one client for the lifetime of the sink, keeps the connection and the csrf token
+        self._client = FHEM(settings['url'], settings['user'], settings['password'], self._log, workers)
+
+    @property
+    def batch(self):
+        return self._settings['batch']
+
+    def publish(self, records):
+        self._log.logMsg('sending to fhem', log.DEBUG)
+        fhem_cmds = []
+        for values in records:
+            values = format_record(values)
+            wrid = values['wrid']
+            if wrid in self._id2device:
+                #values = ['wrid', 'ac', 'dc', 'temp', 'power', 'totalkwh', 'freq']
+                for key, value in values.items():
+                    fhem_cmds.append(f'set {self._id2device[wrid]} {key} {value}')
+            else:
+                self._log.logMsg(f'No FHEM device known for converter ID {wrid}', log.WARN)
+        self._log.logMsg('fhem commands: %s', log.DEBUG, fhem_cmds)
+        if not self._client.send_commands(fhem_cmds):
+            raise ConnectionError('fhem did not take the commands')
@@ -4,153 +4,620 @@ import sys
 import os
 import time
 import signal
-import errno
 import socket
-import select
+import asyncio
+import threading
+import itertools
 from log import log
+from metrics import Metrics
+
+
+class Circuit:
+    # circuit breaker for the portal connection, shared by all bridge connections
+    # after a failed connect no further attempt is made until the backoff time is over,
+    # then a single connect is let through, the backoff doubles on each failure in a row,
+    # connects which were already running when the circuit opened count as one failure
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, backoff = 5, backoff_max = 300):
+        self._backoff_base = backoff
+        self._backoff_max  = backoff_max
+        self._failures     = 0
+        self._retry_at     = 0
+        self._opened_at    = 0
+        self._backoff      = 0
+        self.state         = self.CLOSED
+
+    def __repr__(self):
+        return f'Circuit({self.state}, failures {self._failures})'
+
+    def set_backoff(self, backoff, backoff_max):
+        self._backoff_base = backoff
+        self._backoff_max  = backoff_max
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() >= self._retry_at:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def success(self):
+        self._failures = 0
+        self.state = self.CLOSED
+
+    def failure(self, started=None):
+        # started: monotonic time the failed connect began
+        now = time.monotonic()
+        if self.state != self.CLOSED and started is not None and started < self._opened_at:
+            return self._backoff
+        self._failures += 1
+        self._backoff = min(self._backoff_base * 2 ** (self._failures - 1), self._backoff_max)
+        self._retry_at = now + self._backoff
+        self._opened_at = now
+        self.state = self.OPEN
+        return self._backoff
+
+    def abandon(self):
+        # a connect ended without result (cancelled), if it was the probe the next connect probes again
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+
+class Session:
+    # one bridge connection and its portal side, keyed by connection id and,
+    # once the first frame is seen, by the bridge account
+    __slots__ = ('id', 'account', 'peer', 'portal_peer', 'c_transport', 'p_transport', 'connecting',
+                 'pending', 'parsers', 'raw', 'opened', 'last_rx', 'last_tx', 'idle',
+                 'rx_frames', 'rx_bytes', 'tx_frames', 'tx_bytes')
+
+    def __init__(self, conn_id):
+        self.id          = conn_id
+        self.account     = None
+        self.peer        = None
+        self.portal_peer = None
+        self.c_transport = None
+        # portal side
+        self.p_transport = None
+        self.connecting  = None
+        self.pending     = []
+        # frame parser per direction
+        self.parsers     = {'client' : None, 'server' : None}
+        # pass the data through without framing and callbacks
+        self.raw         = False
+        self.opened      = time.time()
+        self.last_rx     = 0.0
+        self.last_tx     = 0.0
+        # timer of the idle check, see TCPProxy.check_idle
+        self.idle        = None
+        # rx: bridge -> portal, tx: portal (or local answer) -> bridge
+        self.rx_frames   = 0
+        self.rx_bytes    = 0
+        self.tx_frames   = 0
+        self.tx_bytes    = 0
+
+    def __repr__(self):
+        account = self.account.hex() if self.account else '-'
+        return f'Session({self.id}, {account}, {self.peer})'
+
+    def transport(self, data_type):
+        return self.c_transport if data_type == 'client' else self.p_transport
+
+    def cancel(self):
+        # stop the portal connect and the idle check
+        if self.connecting is not None:
+            self.connecting.cancel()
+        if self.idle is not None:
+            self.idle.cancel()
+            self.idle = None
+
+    def stats(self):
+        return {'account'     : self.account.hex() if self.account else None,
+                'peer'        : self.peer,
+                'portal_peer' : self.portal_peer,
+                'opened'      : self.opened,
+                'last_rx'     : self.last_rx,
+                'last_tx'     : self.last_tx,
+                'rx_frames'   : self.rx_frames,
+                'rx_bytes'    : self.rx_bytes,
+                'tx_frames'   : self.tx_frames,
+                'tx_bytes'    : self.tx_bytes}
+
+
+class Pipe(asyncio.BufferedProtocol):
+    # one side (client or server) of a session, the data read goes to TCPProxy.received,
+    # which writes it to the other side.
+    # The reads go directly into a preallocated buffer (recv_into), the data is only valid
+    # until the next read. A transport keeps the data it could not send, so a new buffer
+    # is taken while the other side has data in its write buffer.
+    def __init__(self, proxy, session, data_type):
+        self._proxy     = proxy
+        self._session   = session
+        self._data_type = data_type
+        self._other     = 'server' if data_type == 'client' else 'client'
+        self._buffer    = memoryview(bytearray(proxy.BUFFSIZE))
+        self.transport  = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._proxy.connection_made(self._session, self._data_type, transport)
+
+    def get_buffer(self, sizehint):
+        other = self._session.transport(self._other)
+        if other is not None and other.get_write_buffer_size():
+            self._buffer = memoryview(bytearray(self._proxy.BUFFSIZE))
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        self._proxy.received(self._session, self._data_type, self._buffer[:nbytes])
+
+    def eof_received(self):
+        # no data means connection close
+        return False
+
+    def connection_lost(self, exc):
+        self._proxy.connection_lost(self._session, self._data_type, exc)
+
+    def pause_writing(self):
+        # the write buffer of this side is full, stop reading the other side
+        self._proxy.pause_reading(self._session, self._other)
+
+    def resume_writing(self):
+        self._proxy.resume_reading(self._session, self._other)
 
 
 class TCPProxy:
-    _socket_list = []
-    _forward_dict = {}
-    _callback_list = []
-    BUFFSIZE = 1024
+    BUFFSIZE = 4096
+    # frames kept per bridge connection while the portal connection is set up,
+    # further reads of the bridge wait for the connect
+    MAX_PENDING = 16
 
-    def __init__(self, listen_ip, listen_port, forward_ip, forward_port, logger = None):
+    def __init__(self, listen_ip, listen_port, forward_ip, forward_port, logger = None, backlog = 128, reuse_port = False):
         self._log = log('TCP-Proxy') if logger is None else logger
         self._listen_ip    = listen_ip
-        self._forward_ip   = forward_ip
         self._forward_port = forward_port
+        self.set_forward_addresses(forward_ip)
         self._forward_timeout = 10
         self._listen_port  = listen_port
+        self._callback_list = []
+        self._framer       = None
+        self._responder    = None
+        self._local_first  = None
+        self._reload       = None
+        self._idle_timeout = 0
+        # (interval, callback) run on the loop while serving, see call_every
+        self._periodic     = []
+        self._timers       = {}
+        self._session_key  = None
+        self._circuit      = Circuit()
+        self._capture      = None
+        self._conn_ids     = itertools.count(1)
+        # connection id -> Session
+        self._sessions     = {}
+        # bridge account -> set of Sessions, a bridge may reconnect before its old connection is gone
+        self._accounts     = {}
+        self._server       = None
+        self._aloop        = None
+        self._stopped      = None
+        self.metrics       = Metrics(self._log)
+        self.init_metrics()
         self._listener     = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # several worker processes listen on the same port, the kernel spreads the connections
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._listener.bind((listen_ip, listen_port))
-        self._listener.listen(2)
-        self._socket_list.append(self._listener)
-        signal.signal(signal.SIGTERM, self.sigterm_handler)
-        signal.signal(signal.SIGINT, self.sigterm_handler)
+        self._listener.listen(backlog)
+        self._listener.setblocking(False)
+
+    def init_metrics(self):
+        m = self.metrics
+        self._m_received = {t : m.counter('iotproxy_received_bytes_total', 'bytes received from client or server', {'data_type' : t})
+                            for t in ('client', 'server')}
+        self._m_sent     = {t : m.counter('iotproxy_sent_bytes_total', 'bytes sent to client or server', {'data_type' : t})
+                            for t in ('client', 'server')}
+        self._m_handle   = {t : m.histogram('iotproxy_handle_data_seconds', 'time in handle_data per frame', {'data_type' : t})
+                            for t in ('client', 'server')}
+        self._m_connect  = m.histogram('iotproxy_portal_connect_seconds', 'time to connect the server')
+        self._m_conn_failed = m.counter('iotproxy_portal_connect_failures_total', 'failed server connects')
+        self._m_local    = m.counter('iotproxy_local_answers_total', 'frames answered locally')
+        self._m_held     = m.counter('iotproxy_upstream_held_total', 'client frames not forwarded to the server')
+        self._m_idle     = m.counter('iotproxy_idle_closed_total', 'client connections closed after idle_timeout')
+        m.add_collector(self.collect_metrics)
+        m.add_collector(self.collect_session_metrics)
+
+    def collect_metrics(self):
+        sessions = list(self._sessions.values())
+        yield ('iotproxy_connections', 'gauge', 'open client connections', [({}, len(sessions))])
+        yield ('iotproxy_portal_connections', 'gauge', 'open server connections',
+               [({}, sum(1 for s in sessions if s.p_transport is not None and not s.p_transport.is_closing()))])
+        yield ('iotproxy_bridges', 'gauge', 'connected bridge accounts', [({}, len(self._accounts))])
+        yield ('iotproxy_portal_circuit_open', 'gauge', 'server circuit breaker open (1) or closed (0)',
+               [({}, int(self._circuit.state != Circuit.CLOSED))])
+
+    def collect_session_metrics(self):
+        # per bridge account, summed over its open connections
+        frames, nbytes, last = [], [], []
+        for account, sessions in list(self._accounts.items()):
+            labels = {'account' : account.hex()}
+            for direction, attr in (('client', 'rx'), ('server', 'tx')):
+                l = dict(labels, data_type=direction)
+                frames.append((l, sum(getattr(s, attr + '_frames') for s in sessions)))
+                nbytes.append((l, sum(getattr(s, attr + '_bytes') for s in sessions)))
+            last.append((labels, max(s.last_rx for s in sessions)))
+        yield ('iotproxy_bridge_frames', 'gauge', 'frames of the open connections per bridge account', frames)
+        yield ('iotproxy_bridge_bytes', 'gauge', 'bytes of the open connections per bridge account', nbytes)
+        yield ('iotproxy_bridge_last_rx_timestamp_seconds', 'gauge', 'time of the last frame from the bridge', last)
+
+    def set_forward_addresses(self, addresses):
+        # one address or a list of addresses of the server, tried in turn on a failed connect,
+        # may be called from another thread, open connections stay with their address
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        self._forward_ips   = tuple(addresses)
+        # the address of the last successful connect is tried first
+        self._forward_index = 0
+
+    def set_forward_port(self, port):
+        # used for the next connects, open connections are kept
+        self._forward_port = port
 
     def set_forward_timeout(self, ti):
         self._forward_timeout = ti
 
+    def set_forward_backoff(self, backoff, backoff_max):
+        self._circuit.set_backoff(backoff, backoff_max)
+
+    def set_local_responder(self, responder):
+        # responder(data) returns the answer to send to the client instead of the server
+        # if the server is not reachable, or None if there is nothing to answer
+        self._responder = responder
+
+    def set_local_first(self, handler):
+        # handler(frame) is asked for each client frame before it is forwarded, it returns None
+        # to forward the frame or the answer for the client instead (b'' for no answer), None = off
+        self._local_first = handler
+
+    def set_session_key(self, session_key):
+        # session_key(data) returns the bridge account of a client frame, or None if the frame
+        # carries none, the session is indexed by the first account found
+        self._session_key = session_key
+
+    def set_idle_timeout(self, timeout):
+        # client connections without data for timeout seconds are closed (0 = never),
+        # half-open connections of dead bridges do not stay forever
+        self._idle_timeout = timeout
+
+    def call_every(self, interval, callback):
+        # callback() runs on the loop every interval seconds while the proxy serves
+        self._periodic.append((interval, callback))
+
+    def set_reload_handler(self, handler):
+        # handler() is called on SIGHUP, on the loop, so it must not block
+        self._reload = handler
+
+    def set_capture(self, capture):
+        # capture.write(data_type, conn_id, frame) is called for every frame before the callbacks
+        self._capture = capture
+
     def register_callback(self, callback):
         self._callback_list.append(callback)
 
-    def create_forward(self, s_in):
-        self._log.logMsg('create forwarder', log.DEBUG)
-        try:
-            s_out = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s_out.settimeout(self._forward_timeout)
-            s_out.connect((self._forward_ip, self._forward_port))
-        except Exception as e:
-            self._log.logMsg(f'create forward failed {e}', log.WARN)
-            return False
+    def set_framer(self, framer):
+        # framer(data_type, logger) creates a parser per connection and direction,
+        # its feed(data) returns the complete frames, each frame is handled separately
+        self._framer = framer
+
+    def create_parser(self, data_type):
+        if self._framer is None:
+            return None
+        return self._framer(data_type, self._log)
+
+    def sessions(self):
+        return list(self._sessions.values())
+
+    def session(self, conn_id):
+        return self._sessions.get(conn_id)
+
+    def sessions_for(self, account):
+        # open connections of one bridge account
+        return list(self._accounts.get(account, ()))
+
+    def session_stats(self):
+        return {s.id : s.stats() for s in list(self._sessions.values())}
+
+    def open_session(self):
+        session = Session(next(self._conn_ids))
+        session.parsers['client'] = self.create_parser('client')
+        session.parsers['server'] = self.create_parser('server')
+        # nothing looks at the data: forward it as read
+        session.raw = self._framer is None and not self._callback_list and self._capture is None
+        self._sessions[session.id] = session
+        return session
+
+    def close_session(self, session):
+        self._sessions.pop(session.id, None)
+        if session.account is not None:
+            sessions = self._accounts.get(session.account)
+            if sessions is not None:
+                sessions.discard(session)
+                if not sessions:
+                    del self._accounts[session.account]
+
+    def set_account(self, session, account):
+        session.account = account
+        self._accounts.setdefault(account, set()).add(session)
+        self._log.logMsg(lambda: f'{session.peer} is bridge {account.hex()}', log.INFO)
+
+    def handle_read(self, session, data_type, data):
+        # split the read into frames and return the data to forward
+        n = len(data)
+        self._m_received[data_type].inc(n)
+        if session.raw:
+            result = [data]
+            frames = ()
         else:
-            if s_in in self._forward_dict:
-                self.close_connection(self._forward_dict[s_in])
-            self._forward_dict[s_in] = s_out
-            self._forward_dict[s_out] = s_in
-            self._socket_list.append(s_out)
-        return s_out
-
-    def delete_forward(self, s_in):
-        if s_in in self._forward_dict:
-            # close also associated forward if exists
-            s_out = self._forward_dict[s_in]
-            try:
-                s_out.close()
-            except Exception as e:
-                self._log.logMsg(f'unable to close {s_out}: {e}', log.WARN)
-            else:
-                if s_out in self._forward_dict:
-                    del self._forward_dict[s_out]
-                if s_out in self._socket_list:
-                    self._socket_list.remove(s_out)
-                del self._forward_dict[s_in]
+            hist = self._m_handle[data_type]
+            result = []
+            frames = session.parsers[data_type].feed(data) if session.parsers[data_type] is not None else (data,)
+        for frame in frames:
+            if data_type == 'client' and session.account is None and self._session_key is not None:
+                account = self._session_key(frame)
+                if account is not None:
+                    self.set_account(session, account)
+            start = time.perf_counter()
+            result.append(self.handle_data(data_type, frame, session.id))
+            hist.observe(time.perf_counter() - start)
+        if data_type == 'client':
+            session.last_rx = time.time()
+            session.rx_frames += len(result)
+            session.rx_bytes += n
+        return result
 
-    def loop(self):
-        while True:
-            time.sleep(0.01)
-            self._log.logMsg('main loop', log.DEBUG)
+    def send(self, transport, data_type, frames, session=None):
+        n = 0
+        for frame in frames:
+            n += len(frame)
+        self._m_sent[data_type].inc(n)
+        if session is not None and data_type == 'client':
+            session.last_tx = time.time()
+            session.tx_frames += len(frames)
+            session.tx_bytes += n
+        transport.writelines(frames)
+
+    async def create_forward(self, session):
+        self._log.logMsg('create forwarder', log.DEBUG)
+        addresses, first = self._forward_ips, self._forward_index
+        for i in range(len(addresses)):
+            index = (first + i) % len(addresses)
+            start = time.perf_counter()
             try:
-                inputready, _, _ = select.select(self._socket_list, [], [])
-            except Exception as e:
-                self._log.logMsg(f'select exception {e}', log.DEBUG)
-                return
-            for s_in in inputready:
-                if s_in == self._listener:
-                    self.accept_connection()
-                else:
-                    try:
-                        data = s_in.recv(self.BUFFSIZE)
-                        self._log.logMsg(f'received: {len(data)} bytes from {s_in.getpeername()} on fd {s_in.fileno()}', log.DEBUG)
-                        if data and len(data) > 0:
-                            data = self.handle_data(s_in, data)
-                            if len(data) and not s_in in self._forward_dict:
-                                # create forwarder
-                                self.create_forward(s_in)
-                            # forward data to proxy peer
-                            if s_in in self._forward_dict and len(data):
-                                self._forward_dict[s_in].send(data)
-                                self._log.logMsg(f'Data forwarded to {self._forward_dict[s_in]}', log.DEBUG)
-                        else: # no data means connection close
-                            self._log.logMsg('socket closed ' + str(s_in), log.DEBUG)
-                            self.close_connection(s_in)
-                            self._log.logMsg('Remaining input list: ' + str(self._socket_list), log.DEBUG)
-                    except OSError as e:
-                        self._log.logMsg('socket read error on ' + str(s_in) + ' ' + str(e), log.WARN)
-                        time.sleep(1) 
-                        # Connection was closed abnormally
-                        self.close_connection(s_in)
-                        self._log.logMsg('Remaining input list: ' + str(self._socket_list), log.DEBUG)
+                transport, _ = await asyncio.wait_for(
+                    self._aloop.create_connection(lambda: Pipe(self, session, 'server'), addresses[index], self._forward_port),
+                    self._forward_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                self._m_conn_failed.inc()
+                self._log.logMsg(f'create forward to {addresses[index]} failed {e!r}', log.WARN)
+                continue
+            self._m_connect.observe(time.perf_counter() - start)
+            if addresses is self._forward_ips:
+                self._forward_index = index
+            return transport
+        return None
 
     def accept_connection(self):
+        # protocol factory of the listener, one session per bridge connection
         self._log.logMsg('Entering accept', log.DEBUG)
-        clientsock, clientaddr = self._listener.accept()
-        self._log.logMsg(f'{clientaddr} has connected', log.DEBUG)
-        self._socket_list.append(clientsock)
-        self._log.logMsg('New connection list: ' + str(self._socket_list), log.DEBUG)
-
-    def close_connection(self, s_in):
-        self._log.logMsg('closeing ' + str(s_in), log.DEBUG)
-        self._log.logMsg('Input list: ' + str(self._socket_list), log.DEBUG)
-        self._log.logMsg('Forward dictionary: ' + str(self._forward_dict), log.DEBUG)
-        if s_in == self._listener:
-            # First connection  cannot be closed: proxy listening on its port
-            self._log.logMsg('tried to close listener', log.ERROR)
+        return Pipe(self, self.open_session(), 'client')
+
+    def connection_made(self, session, data_type, transport):
+        # the portal side is connected on the first data to forward, see connect_forward
+        if data_type == 'client':
+            session.c_transport = transport
+            session.peer = transport.get_extra_info('peername')
+            self._log.logMsg('%s has connected', log.DEBUG, session.peer)
+            self.arm_idle(session)
+
+    def received(self, session, data_type, data):
+        if data_type == 'client':
+            self._log.logMsg('received: %d bytes from %s', log.DEBUG, len(data), session.peer)
+            if session.idle is None:
+                # idle_timeout was switched on by a reload
+                self.arm_idle(session)
+        frames = [f for f in self.handle_read(session, data_type, data) if len(f)]
+        if not frames:
+            return
+        if data_type == 'client':
+            if self._local_first is not None:
+                frames = self.answer_first(session, frames)
+                if not frames:
+                    return
+            self.forward(session, frames)
+        elif not session.c_transport.is_closing():
+            self.send(session.c_transport, 'client', frames, session)
+
+    def connection_lost(self, session, data_type, exc):
+        if data_type == 'server':
+            # a closed portal connection also closes the bridge connection
+            if exc is not None:
+                self._log.logMsg(f'portal read error {exc}', log.WARN)
+            else:
+                self._log.logMsg('portal closed connection', log.DEBUG)
+            if session.c_transport is not None:
+                session.c_transport.close()
+            return
+        if exc is not None:
+            # Connection was closed abnormally
+            self._log.logMsg(f'socket read error on {session.peer} {exc}', log.WARN)
+        else:
+            self._log.logMsg('socket closed %s', log.DEBUG, session.peer)
+        session.cancel()
+        if session.p_transport is not None:
+            session.p_transport.close()
+        self.close_session(session)
+        self._log.logMsg('Remaining connections: %d', log.DEBUG, len(self._sessions))
+
+    def arm_idle(self, session, delay=None):
+        if self._idle_timeout:
+            session.idle = self._aloop.call_later(self._idle_timeout if delay is None else delay,
+                                                  self.check_idle, session)
+
+    def check_idle(self, session):
+        # The timer is not moved on every read, it runs once per idle_timeout and is armed
+        # again for the rest of the timeout if the bridge sent data meanwhile.
+        session.idle = None
+        if not self._idle_timeout or session.c_transport is None:
+            return
+        idle = time.time() - max(session.opened, session.last_rx)
+        if idle < self._idle_timeout:
+            self.arm_idle(session, self._idle_timeout - idle)
             return
-        self.delete_forward(s_in)
+        self._log.logMsg(f'{session.peer} idle for {idle:.0f}s, closing', log.INFO)
+        self._m_idle.inc()
+        # a half-open connection would never send its write buffer, connection_lost closes the portal side
+        session.c_transport.abort()
+
+    def run_periodic(self, index):
+        interval, callback = self._periodic[index]
         try:
-            s_in.close()
+            callback()
         except Exception as e:
-            self._log.logMsg(f'unable to close {s_in}: {e}', log.WARN)
-        else:    
-            if s_in in self._socket_list:
-                self._socket_list.remove(s_in)
+            self._log.logMsg(f'periodic task {callback} failed {e!r}', log.ERROR)
+        self._timers[index] = self._aloop.call_later(interval, self.run_periodic, index)
+
+    def pause_reading(self, session, data_type):
+        transport = session.transport(data_type)
+        if transport is not None and not transport.is_closing():
+            transport.pause_reading()
+
+    def resume_reading(self, session, data_type):
+        transport = session.transport(data_type)
+        if transport is not None and not transport.is_closing():
+            transport.resume_reading()
+
+    def forward(self, session, frames):
+        p_transport = session.p_transport
+        if p_transport is not None and not p_transport.is_closing():
+            # forward data to proxy peer, the transport buffers what can not be sent now
+            self.send(p_transport, 'server', frames)
+            self._log.logMsg('Data forwarded to %s', log.DEBUG, session.portal_peer)
+            return
+        if session.connecting is None:
+            if not self._circuit.allow():
+                self.answer_locally(session, frames)
+                return
+            session.connecting = asyncio.ensure_future(self.connect_forward(session))
+        # the read buffer is reused, keep copies
+        session.pending.extend(bytes(f) for f in frames)
+        if len(session.pending) >= self.MAX_PENDING:
+            # stop reading this bridge until the portal is connected (or failed)
+            self.pause_reading(session, 'client')
+
+    async def connect_forward(self, session):
+        # runs beside the bridge connection, so the bridge is read on while the portal is connected
+        started = time.monotonic()
+        try:
+            p_transport = await self.create_forward(session)
+        except asyncio.CancelledError:
+            self._circuit.abandon()
+            raise
+        except Exception as e:
+            self._log.logMsg(f'create forward failed {e!r}', log.ERROR)
+            p_transport = None
+        session.connecting = None
+        pending, session.pending = session.pending, []
+        self.resume_reading(session, 'client')
+        if p_transport is None:
+            backoff = self._circuit.failure(started)
+            self._log.logMsg(f'portal not reachable, next try in {backoff}s', log.INFO)
+            self.answer_locally(session, pending)
+            return
+        self._circuit.success()
+        if session.c_transport.is_closing():
+            p_transport.close()
+            return
+        session.p_transport = p_transport
+        session.portal_peer = p_transport.get_extra_info('peername')
+        self.send(p_transport, 'server', pending)
+
+    def answer_first(self, session, frames):
+        # returns the frames to forward
+        forward = []
+        for frame in frames:
+            answer = self._local_first(frame)
+            if answer is None:
+                forward.append(frame)
+                continue
+            self._m_held.inc()
+            if answer and not session.c_transport.is_closing():
+                self._m_local.inc()
+                self.send(session.c_transport, 'client', (answer,), session)
+        return forward
+
+    def answer_locally(self, session, frames):
+        c_transport = session.c_transport
+        if self._responder is None or c_transport.is_closing():
+            return
+        for frame in frames:
+            answer = self._responder(frame)
+            if answer:
+                self._log.logMsg('answered locally (%d)', log.DEBUG, len(answer))
+                self._m_local.inc()
+                self.send(c_transport, 'client', (answer,), session)
 
     def close_all(self):
         # Close all connections
         self._log.logMsg('closeing all', 5)
-        self._log.logMsg('Connections to close: ' + str(self._socket_list), log.DEBUG)
-        while len(self._socket_list) > 1:
-            self.close_connection(self._socket_list[1])
-        self._listener.close()
-
-    # handle the date, return the original data modify if needed 
-    def handle_data(self, s_in, data):
-        data_type = 'server'
-        if s_in.getsockname()[1] == self._listen_port:
-            data_type = 'client'
-        self._log.logMsg(f'{data_type}data to handle ({len(data)})', log.DEBUG)
+        self._log.logMsg('Connections to close: %d', log.DEBUG, len(self._sessions))
+        for session in list(self._sessions.values()):
+            session.cancel()
+            if session.c_transport is not None:
+                session.c_transport.close()
+        if self._server is not None:
+            self._server.close()
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        if self._capture is not None:
+            self._capture.flush()
+        if self._stopped is not None:
+            self._stopped.set()
+
+    # handle the data, return the original data modify if needed
+    def handle_data(self, data_type, data, conn_id=0):
+        self._log.logMsg('%sdata to handle (%d)', log.DEBUG, data_type, len(data))
+        if self._capture is not None:
+            self._capture.write(data_type, conn_id, data)
         for cb in self._callback_list:
             data = cb(data_type, data)
         return data
 
-    def sigterm_handler(self, signal, frame):
+    def sigterm_handler(self):
         self._log.logMsg('Received SIGTERM, closing connections', log.INFO)
         self.close_all()
-        self._log.logMsg('Stopping server', 1)
 
+    async def serve(self):
+        self._aloop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            self._aloop.add_signal_handler(signal.SIGTERM, self.sigterm_handler)
+            self._aloop.add_signal_handler(signal.SIGINT, self.sigterm_handler)
+            if self._reload is not None:
+                self._aloop.add_signal_handler(signal.SIGHUP, self._reload)
+        self._server = await self._aloop.create_server(self.accept_connection, sock=self._listener)
+        for index, (interval, callback) in enumerate(self._periodic):
+            self._timers[index] = self._aloop.call_later(interval, self.run_periodic, index)
+        await self._stopped.wait()
+        await asyncio.sleep(0)
+        self._log.logMsg('Stopping server', 1)
 
+    def loop(self):
+        asyncio.run(self.serve())
 
+    def stop(self):
+        # thread safe stop, used if the proxy runs outside the main thread
+        if self._aloop is not None:
+            self._aloop.call_soon_threadsafe(self.close_all)
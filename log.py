@@ -1,22 +1,44 @@
+
+
 import sys
+import queue
+import atexit
 import logging
 import logging.handlers
 
 class log:
-    
+
     # Verbosity levels (1-5)
     CRITICAL = 1
     ERROR    = 2
     WARN     = 3
     INFO     = 4
     DEBUG    = 5
-    
+
+    # one listener thread per identifier, it does the formatting and output of the records,
+    # so writing to syslog or stdout never blocks the caller
+    _listeners = {}
+    # in a worker process (queue, prefix): the records go to the supervisor, see forward_to
+    _forward = None
+
     def __init__(self, identifier='', verbosity = 3, log_type='syslog', log_address='/dev/log', log_port=514):
         self._identifier  = identifier
+        self.configure(verbosity, log_type, log_address, log_port)
+
+    def configure(self, verbosity = 3, log_type='syslog', log_address='/dev/log', log_port=514):
+        # sets verbosity and output, called again on a reload of the config,
+        # every holder of this log object gets the new settings
         self._type      = log_type
         self._address   = log_address
         self._port      = log_port
         self.set_verbosity(verbosity)
+        if self._forward is not None:
+            # worker process, the output is done by the supervisor
+            self._logger = logging.getLogger(self._identifier)
+            self._logger.setLevel(self.level_to_category(self._verbosity))
+            self._logger.handlers.clear()
+            self._logger.addHandler(self._forward_handler())
+            return
         l = False
         if log_type == 'stdout':
             l = logging.StreamHandler(sys.stdout)
@@ -37,15 +59,21 @@ class log:
             print(f'can not set logger {log_type}')
             raise ValueError
         self._logger = logging.getLogger(self._identifier)
-        self._logger.setLevel(self.level_to_category(self._verbosity))   
+        self._logger.setLevel(self.level_to_category(self._verbosity))
         if self._logger.handlers:
             # remove previous handler
             self._logger.handlers.pop()
-        self._logger.addHandler(l)
+        if self._identifier in self._listeners:
+            self._listeners.pop(self._identifier).stop()
+        q = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(q, l)
+        listener.start()
+        self._listeners[self._identifier] = listener
+        self._logger.addHandler(logging.handlers.QueueHandler(q))
 
     def __repr__(self):
         return f'log({self._identifier}, {self._verbosity}, {self._type}, {self._address}, {self._port}'
-    
+
     def level_to_category(self, level):
         if level == 1:
             return logging.CRITICAL
@@ -60,9 +88,19 @@ class log:
         else:
             return logging.NOTSET
 
-    def logMsg (self, msg, level = 3, cat = None):
+    def enabled(self, level):
+        return level <= self._verbosity
+
+    def logMsg (self, msg, level = 3, *args):
         # Only write to log if level <= verbosity
+        # the message is only built if it is written:
+        #   logMsg('received %d bytes', log.DEBUG, len(data))    % formatting with args
+        #   logMsg(lambda: f'hex {data.hex()}', log.DEBUG)       msg is called
         if level <= self._verbosity:
+            if callable(msg):
+                msg = msg()
+            elif args:
+                msg = msg % args
             if self._type == 'syslog' and len(msg) > 512:
                 self._logger.log(self.level_to_category(level), msg[:512])
                 p = 1
@@ -71,10 +109,52 @@ class log:
                     p += 1
             else:
                 self._logger.log(self.level_to_category(level), msg)
-            
+
     def set_verbosity(self, verbosity):
         if verbosity < 1:
             verbosity = 1
         if verbosity > 5:
             verbosity = 5
         self._verbosity = verbosity
+
+    @classmethod
+    def stop_all(cls):
+        # write out the queued records
+        while cls._listeners:
+            cls._listeners.popitem()[1].stop()
+
+    @classmethod
+    def _forward_handler(cls):
+        q, prefix = cls._forward
+        handler = logging.handlers.QueueHandler(q)
+        if prefix:
+            def add_prefix(record):
+                record.msg = prefix + str(record.msg)
+                return True
+            handler.addFilter(add_prefix)
+        return handler
+
+    @classmethod
+    def forward_to(cls, q, prefix=''):
+        # called at the start of a worker process, before its loggers are created:
+        # the records of all loggers are put on q (a multiprocessing queue) instead
+        cls._forward = (q, prefix)
+        identifiers = list(cls._listeners)
+        cls._listeners.clear()
+        for identifier in identifiers:
+            logger = logging.getLogger(identifier)
+            logger.handlers.clear()
+            logger.addHandler(cls._forward_handler())
+
+    @classmethod
+    def receive_from(cls, q):
+        # counterpart of forward_to in the supervisor, the records of the workers are written
+        # by the handlers of the logger with the same name in this process
+        class Dispatch(logging.Handler):
+            def handle(self, record):
+                logging.getLogger(record.name).handle(record)
+        listener = logging.handlers.QueueListener(q, Dispatch())
+        listener.start()
+        return listener
+
+atexit.register(log.stop_all)
@@ -0,0 +1,162 @@
+
+import bisect
+import threading
+import http.server
+from log import log
+
+
+class Counter:
+    # monotonic counter, inc() is all that is done on the hot path
+    __slots__ = ('value',)
+    type = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    type = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    # fixed buckets, observe() only increments preallocated counts
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+    type = 'histogram'
+    BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum    = 0.0
+        self.count  = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield f'{name}_bucket', labels + (('le', repr(float(bound))),), cumulative
+        yield f'{name}_bucket', labels + (('le', '+Inf'),), self.count
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+class Metrics:
+    # Registry of the metrics, rendered in the prometheus text format.
+    # Instruments are created once (i.e. in __init__ of the user) and kept,
+    # values which already exist elsewhere (queue depth, connections) are read at scrape time
+    # by collectors: collector() returns (name, type, help, [(labels, value), ...]) tuples.
+
+    def __init__(self, logger=None):
+        self._log        = log('Metrics') if logger is None else logger
+        self._metrics    = {}
+        self._collectors = []
+        self._sources    = []
+        self._server     = None
+
+    def _get(self, cls, name, help, labels):
+        labels = tuple(sorted(labels.items())) if labels else ()
+        family = self._metrics.setdefault(name, [cls.type, help, {}])
+        if labels not in family[2]:
+            family[2][labels] = cls()
+        return family[2][labels]
+
+    def counter(self, name, help='', labels=None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=None):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=None):
+        return self._get(Histogram, name, help, labels)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def add_source(self, source):
+        # source() returns families as returned by families(), i.e. of other processes
+        self._sources.append(source)
+
+    def families(self):
+        # [(name, type, help, [(sample name, labels, value), ...]), ...], plain values only,
+        # so it can be handed to another process
+        families = []
+        for name, (t, h, series) in list(self._metrics.items()):
+            samples = []
+            for labels, metric in list(series.items()):
+                samples.extend(metric.samples(name, labels))
+            families.append((name, t, h, samples))
+        for collector in self._collectors:
+            try:
+                for name, t, h, series in collector():
+                    families.append((name, t, h, [(name, tuple(sorted(l.items())), v) for l, v in series]))
+            except Exception as e:
+                self._log.logMsg(f'metrics collector failed: {e}', log.WARN)
+        for source in self._sources:
+            try:
+                families.extend(source())
+            except Exception as e:
+                self._log.logMsg(f'metrics source failed: {e}', log.WARN)
+        return families
+
+    def render(self):
+        # families of the same name (from several sources) are written as one
+        merged = {}
+        for name, t, h, samples in self.families():
+            merged.setdefault(name, (t, h, []))[2].extend(samples)
+        lines = []
+        for name, (t, h, samples) in merged.items():
+            lines.append(f'# HELP {name} {h}')
+            lines.append(f'# TYPE {name} {t}')
+            for sample, l, value in samples:
+                if l:
+                    l = ','.join(f'{k}="{v}"' for k, v in l)
+                    lines.append(f'{sample}{{{l}}} {value}')
+                else:
+                    lines.append(f'{sample} {value}')
+        lines.append('')
+        return '\n'.join(lines)
+
+    def serve(self, address='127.0.0.1', port=9101):
+        # GET /metrics on a thread of its own
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                metrics._log.logMsg('metrics ' + format, log.DEBUG, *args)
+
+        self._server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        self._log.logMsg(f'metrics on http://{address}:{port}/metrics', log.INFO)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
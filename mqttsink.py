@@ -0,0 +1,79 @@
+
+import json
+import paho.mqtt.client as mqtt
+from enverdecode import format_record
+from sinks import Sink
+from log import log
+
+
+class MQTTSink(Sink):
+    # mode values: <base_topic>/<wrid>/<key> per value of a record (send_json = False)
+    #      json:   <base_topic>/<wrid> one json document per record (send_json = True)
+    #      frame:  <base_topic>/frame/<bridge> one json document with all inverters of a frame
+    # rollups go to <base_topic>/<topic of [aggregate]>/<bridge>
+    MODES = ('values', 'json', 'frame')
+    rollups = True
+
+    @classmethod
+    def read_settings(cls, section):
+        mode = section.get('mode', 'json' if section.get('send_json', 'False') == 'True' else 'values')
+        if mode not in cls.MODES:
+            raise ValueError(f'unknown mqtt mode {mode}')
+        qos = int(section.get('qos', 0))
+        if qos not in (0, 1, 2):
+            raise ValueError(f'mqtt qos {qos} is not 0, 1 or 2')
+        return {'host'       : section.get('host', 'localhost'),
+                'port'       : int(section.get('port', 1883)),
+                'base_topic' : section.get('base_topic', 'enverproxy'),
+                'mode'       : mode,
+                'qos'        : qos,
+                'retain'     : section.get('retain', 'False') == 'True'}
+
+    def __init__(self, name, settings, logger=None, workers=1):
+        super().__init__(name, settings, logger, workers)
+        self.records = 'frame' if settings['mode'] == 'frame' else 'record'
+        self._topic  = settings['base_topic']
+        self._qos    = settings['qos']
+        self._retain = settings['retain']
+        self._log.logMsg(f"Starting mqtt client to {settings['host']}:{settings['port']}", log.INFO)
+        self._client = mqtt.Client()
+        # the connect (and reconnects) run in the network thread of paho, so a broker which is down
+        # does not stop the proxy, meanwhile the records are spooled
+        self._client.connect_async(settings['host'], settings['port'])
+        self._client.loop_start()
+
+    def send(self, topic, payload):
+        self._log.logMsg('send %s :%s', log.DEBUG, topic, payload)
+        info = self._client.publish(topic, payload, self._qos, self._retain)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f'mqtt publish failed: {mqtt.error_string(info.rc)}')
+
+    def connected(self):
+        if not self._client.is_connected():
+            # the sink queue spools the record, paho reconnects in the background
+            raise ConnectionError('mqtt not connected')
+
+    def publish(self, values):
+        self._log.logMsg('sending mqtt', log.DEBUG)
+        self.connected()
+        if self.records == 'frame':
+            document = {'timestamp' : values['timestamp'], 'inverters' : [format_record(r) for r in values['records']]}
+            self.send(f"{self._topic}/frame/{values['bridge']}", json.dumps(document, indent = None))
+            return
+        values = format_record(values)
+        wrid = values['wrid']
+        if self._settings['mode'] == 'json':
+            self.send(f'{self._topic}/{wrid}', json.dumps(values, indent = None))
+            return
+        for key, value in values.items():
+            if key == 'wrid':
+                continue
+            self.send(f'{self._topic}/{wrid}/{key}', value)
+
+    def publish_rollup(self, rollup, topic):
+        self.connected()
+        self.send(f"{self._topic}/{topic}/{rollup['bridge']}", json.dumps(rollup, indent = None))
+
+    def close(self):
+        self._client.loop_stop()
+        self._client.disconnect()
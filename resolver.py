@@ -0,0 +1,115 @@
+
+import os
+import json
+import time
+import threading
+import DNS
+from log import log
+
+
+class PortalResolver:
+    # Looks up the portal name on a thread of its own, so nobody waits for dns.
+    # All A records of an answer are kept, the proxy tries them in turn. The name is looked up
+    # again after the ttl of the answer (at least min_ttl), after a failure in retry seconds.
+    # The last good answer is saved to cache_file and used at the next start until the
+    # first lookup is done, without cache the fallback addresses are used.
+    A = 1
+
+    def __init__(self, name, server='8.8.8.8', cache_file='', fallback=(), logger=None,
+                 timeout=3, min_ttl=60, max_ttl=86400, retry=30):
+        self._log        = log('Resolver') if logger is None else logger
+        self._name       = name
+        self._server     = server
+        self._cache_file = cache_file
+        self._timeout    = timeout
+        self._min_ttl    = min_ttl
+        self._max_ttl    = max_ttl
+        self._retry      = retry
+        self._listeners  = []
+        self._stop       = threading.Event()
+        self._thread     = None
+        self._addresses  = list(fallback)
+        # time of the next lookup
+        self._expires    = 0
+        self.load()
+
+    def __repr__(self):
+        return f'PortalResolver({self._name}, {self._addresses})'
+
+    def addresses(self):
+        return list(self._addresses)
+
+    def add_listener(self, listener):
+        # listener(addresses) is called on the resolver thread when the addresses change
+        self._listeners.append(listener)
+
+    def load(self):
+        if not self._cache_file or not os.path.isfile(self._cache_file):
+            return
+        try:
+            with open(self._cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            self._log.logMsg(f'dns cache {self._cache_file} not readable: {e}', log.WARN)
+            return
+        if cached.get('name') != self._name or not cached.get('addresses'):
+            return
+        self._addresses = cached['addresses']
+        # an expired answer is still better than the fallback, but looked up again at once
+        self._expires = cached.get('expires', 0)
+        self._log.logMsg(f'using cached {self._addresses} for {self._name}', log.INFO)
+
+    def save(self):
+        if not self._cache_file:
+            return
+        tmp = f'{self._cache_file}.{os.getpid()}'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'name' : self._name, 'addresses' : self._addresses, 'expires' : self._expires}, f)
+            os.replace(tmp, self._cache_file)
+        except OSError as e:
+            self._log.logMsg(f'dns cache {self._cache_file} not writable: {e}', log.WARN)
+
+    def resolve(self):
+        # one lookup, returns (addresses, ttl) or None
+        try:
+            r = DNS.DnsRequest(server=self._server, timeout=self._timeout).req(name=self._name, qtype='A')
+        except (DNS.Error, OSError) as e:
+            self._log.logMsg(f'dns lookup of {self._name} failed: {e}', log.INFO)
+            return None
+        answers = [a for a in r.answers if a.get('type') == self.A]
+        if not answers:
+            self._log.logMsg(f'dns record of {self._name} empty', log.WARN)
+            return None
+        ttl = min(a.get('ttl', self._min_ttl) for a in answers)
+        return [a['data'] for a in answers], min(max(ttl, self._min_ttl), self._max_ttl)
+
+    def update(self):
+        result = self.resolve()
+        if result is None:
+            return self._retry
+        addresses, ttl = result
+        self._expires = time.time() + ttl
+        if addresses != self._addresses:
+            self._log.logMsg(f'{self._name} is {addresses} (ttl {ttl}s)', log.INFO)
+            self._addresses = addresses
+            for listener in self._listeners:
+                listener(list(addresses))
+        self.save()
+        return ttl
+
+    def run(self):
+        delay = max(self._expires - time.time(), 0)
+        while not self._stop.wait(delay):
+            delay = self.update()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='resolver', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self._timeout + 1)
+            self._thread = None
@@ -0,0 +1,253 @@
+
+import time
+import threading
+import itertools
+from collections import OrderedDict
+from log import log
+
+
+class SinkQueue:
+    # Bounded queue in front of one sink (mqtt, fhem, ...), drained by worker threads,
+    # so a slow sink does not stall the proxy loop.
+    #
+    # policies:
+    #   drop-oldest  if the queue is full the oldest queued record is dropped
+    #   block        if the queue is full the producer waits until there is room again
+    #   coalesce     a queued record of the same wrid is always merged with the new one in place,
+    #                full or not, if there is none and the queue is full the oldest record is dropped
+    #
+    # with batch > 1 publish is called with a list of up to batch queued records,
+    # i.e. all inverters of a frame are published in one go
+    # key(values) gives the key records are coalesced on, the wrid by default,
+    # merge(old, new) the merged record, by default the fields of new update old
+    #
+    # stats: published counts the records the sink took (spooled ones once they are replayed),
+    # dropped the records lost by a full queue or a failed publish which was not spooled
+    #
+    # with a spool (see spool.py) the records of a failed publish are written to disk,
+    # as are all new records while the spool is not empty, so the order is kept.
+    # The spool is replayed with at most replay_rate records per second, after a failure
+    # the next try is made after retry seconds.
+    DROP_OLDEST = 'drop-oldest'
+    BLOCK       = 'block'
+    COALESCE    = 'coalesce'
+    POLICIES    = (DROP_OLDEST, BLOCK, COALESCE)
+    # log the stats every n published records
+    STATS_EVERY = 1000
+    # seconds between the replay steps
+    REPLAY_WAIT = 0.1
+
+    def __init__(self, name, publish, maxsize=1000, policy=DROP_OLDEST, workers=1, logger=None, batch=1, key=None,
+                 spool=None, replay_rate=100, retry=10, merge=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown queue policy {policy}')
+        self.name      = name
+        self._publish  = publish
+        self._maxsize  = maxsize
+        self._policy   = policy
+        self._workers  = workers
+        self._batch    = batch
+        self._key      = (lambda values: values['wrid']) if key is None else key
+        self._merge    = (lambda old, values: {**old, **values}) if merge is None else merge
+        self._log      = log('SinkQueue') if logger is None else logger
+        self._items    = OrderedDict()
+        self._seq      = itertools.count()
+        self._cond     = threading.Condition()
+        self._threads  = []
+        self._running  = False
+        self._busy     = 0
+        self._spool    = spool
+        self._replay_rate = replay_rate
+        self._retry    = retry
+        self._retry_at = 0.0
+        self._replaying = threading.Lock()
+        # stats
+        self._max_depth = 0
+        self._dropped   = 0
+        self._coalesced = 0
+        self._published = 0
+        # published directly, the base of the averages
+        self._timed     = 0
+        self._errors    = 0
+        self._wait_sum  = 0.0
+        self._pub_sum   = 0.0
+        self._pub_max   = 0.0
+
+    def __repr__(self):
+        return f'SinkQueue({self.name}, {self._policy}, {len(self._items)}/{self._maxsize})'
+
+    def start(self):
+        if self._spool is not None:
+            self._spool.open()
+        self._running = True
+        for i in range(self._workers):
+            t = threading.Thread(target=self.worker, name=f'{self.name}-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=5):
+        # let the workers publish what is queued, then stop them
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.wait_for(lambda: not self._items and not self._busy, timeout)
+            self._running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(max(0, deadline - time.monotonic()))
+        self._threads = []
+        if self._spool is not None:
+            self._spool.close()
+
+    def put(self, values):
+        with self._cond:
+            if self._policy == self.COALESCE:
+                key = self._key(values)
+                if key in self._items:
+                    # records may only hold the changed fields, so merge them
+                    queued, old = self._items[key]
+                    self._items[key] = (queued, self._merge(old, values))
+                    self._coalesced += 1
+                    return
+            else:
+                key = next(self._seq)
+            if len(self._items) >= self._maxsize:
+                if self._policy == self.BLOCK:
+                    self._cond.wait_for(lambda: len(self._items) < self._maxsize or not self._running)
+                else:
+                    self._items.popitem(last=False)
+                    self._dropped += 1
+                    if self._dropped % 100 == 1:
+                        self._log.logMsg(f'{self.name} queue full, {self._dropped} records dropped', log.WARN)
+            self._items[key] = (time.monotonic(), values)
+            self._max_depth = max(self._max_depth, len(self._items))
+            self._cond.notify()
+
+    def worker(self):
+        spool = self._spool
+        while True:
+            with self._cond:
+                if spool is not None and (spool.pending() or spool.dirty()):
+                    # wake up for the replay and the fsync of the spool
+                    timeout = max(self._retry_at - time.monotonic(), self.REPLAY_WAIT)
+                    if spool.dirty():
+                        timeout = min(timeout, spool.sync_interval)
+                    self._cond.wait_for(lambda: self._items or not self._running, timeout)
+                else:
+                    self._cond.wait_for(lambda: self._items or not self._running)
+                if not self._items:
+                    if not self._running:
+                        return
+                    items = None
+                elif self._batch > 1:
+                    items = [self._items.popitem(last=False)[1] for _ in range(min(self._batch, len(self._items)))]
+                    queued = items[0][0]
+                    values = [v for _, v in items]
+                else:
+                    _, (queued, values) = self._items.popitem(last=False)
+                    items = (values,)
+                if items is not None:
+                    self._busy += 1
+                    self._cond.notify_all()
+            if spool is not None:
+                spool.sync_due()
+            if items is None:
+                self.replay()
+                continue
+            start = time.monotonic()
+            # published, spooled (counted as published when replayed) or dropped
+            published = dropped = False
+            if spool is not None and spool.pending():
+                # the new records go behind the spooled ones
+                spool.append(values if self._batch > 1 else items)
+                self.replay()
+            else:
+                try:
+                    self._publish(values)
+                    published = True
+                except OSError as e:
+                    # sink not reachable
+                    self._errors += 1
+                    self._log.logMsg(f'{self.name} publish failed: {e}', log.WARN)
+                    if spool is not None:
+                        spool.append(values if self._batch > 1 else items)
+                        self._retry_at = time.monotonic() + self._retry
+                    else:
+                        dropped = True
+                except Exception as e:
+                    # would fail again, not spooled
+                    self._errors += 1
+                    self._log.logMsg(f'{self.name} publish failed: {e!r}', log.WARN)
+                    dropped = True
+            done = time.monotonic()
+            with self._cond:
+                self._busy -= 1
+                if published:
+                    self.count_published(len(items))
+                    self._timed    += len(items)
+                    self._wait_sum += (start - queued) * len(items)
+                    self._pub_sum  += done - start
+                    self._pub_max   = max(self._pub_max, done - start)
+                elif dropped:
+                    self._dropped += len(items)
+                self._cond.notify_all()
+
+    def count_published(self, n):
+        self._published += n
+        if self._published // self.STATS_EVERY != (self._published - n) // self.STATS_EVERY:
+            self._log.logMsg(f'{self.name} queue stats {self.stats()}', log.INFO)
+
+    def replay(self):
+        # publishes up to a second worth of spooled records in order, stops at the first failure
+        if time.monotonic() < self._retry_at or not self._replaying.acquire(blocking=False):
+            return
+        try:
+            records = self._spool.read(max(self._batch, self._replay_rate))
+            start = time.monotonic()
+            step = max(self._batch, 1)
+            for i in range(0, len(records), step):
+                if not self._running:
+                    return
+                # damaged records are None
+                values = [r for r in records[i:i + step] if r is not None]
+                try:
+                    if values:
+                        self._publish(values if self._batch > 1 else values[0])
+                        with self._cond:
+                            self.count_published(len(values))
+                except OSError as e:
+                    self._errors += 1
+                    self._retry_at = time.monotonic() + self._retry
+                    self._log.logMsg(f'{self.name} replay failed: {e}, {self._spool.pending()} records spooled', log.WARN)
+                    return
+                except Exception as e:
+                    # dropped, it would block the spool
+                    self._errors += 1
+                    with self._cond:
+                        self._dropped += len(values)
+                    self._log.logMsg(f'{self.name} replay of a record failed: {e!r}, dropped', log.WARN)
+                self._spool.commit(len(records[i:i + step]))
+                delay = start + (i + step) / self._replay_rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if records and not self._spool.pending():
+                self._log.logMsg(f'{self.name} spool replayed', log.INFO)
+        finally:
+            self._replaying.release()
+
+    def depth(self):
+        return len(self._items)
+
+    def stats(self):
+        n = self._timed or 1
+        return {'depth'           : len(self._items),
+                'max_depth'       : self._max_depth,
+                'published'       : self._published,
+                'dropped'         : self._dropped,
+                'coalesced'       : self._coalesced,
+                'errors'          : self._errors,
+                'queue_wait_avg'  : self._wait_sum / n,
+                'publish_avg'     : self._pub_sum / n,
+                'publish_max'     : self._pub_max,
+                'spooled'         : self._spool.pending() if self._spool is not None else 0,
+                'replayed'        : self._spool.replayed if self._spool is not None else 0,
+                'evicted'         : self._spool.evicted if self._spool is not None else 0}
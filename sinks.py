@@ -0,0 +1,113 @@
+
+import sys
+import json
+import importlib
+from enverdecode import format_record
+from log import log
+
+# Sinks publish the decoded records, each configured by a section of the config file named
+# like the sink ([mqtt], [fhem], [file]). The module of a sink is only imported if it is
+# configured, so i.e. paho is not needed without mqtt.
+# Other packages can add sinks with an entry point in the group 'enverproxy.sinks',
+# the name of the entry point is the name of the section.
+BUILTIN = {'mqtt' : ('mqttsink', 'MQTTSink'),
+           'fhem' : ('fhemsink', 'FHEMSink'),
+           'file' : ('sinks', 'FileSink')}
+ENTRY_POINTS = 'enverproxy.sinks'
+
+
+class Sink:
+    # records:  'record' publish(values) gets one record,
+    #           'batch'  publish(records) gets a list of up to batch queued records,
+    #           'frame'  publish(frame) gets {'bridge', 'timestamp', 'records'} per frame
+    # rollups:  publish_rollup(rollup, topic) takes the rollups of enveraggregate
+    # publish raises OSError if the target is not reachable, the records are spooled then.
+    # flush() is called every few seconds, a sink which buffers writes them out.
+    records = 'record'
+    rollups = False
+
+    @classmethod
+    def read_settings(cls, section):
+        # checks the config section, returns the settings for __init__ (compared on reload),
+        # raises ValueError
+        return dict(section)
+
+    def __init__(self, name, settings, logger=None, workers=1):
+        self.name      = name
+        self._settings = settings
+        self._log      = log(name) if logger is None else logger
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.name})'
+
+    @property
+    def batch(self):
+        return 1
+
+    def publish(self, values):
+        raise NotImplementedError
+
+    def publish_rollup(self, rollup, topic):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def find(name):
+    # the sink class of a config section, None if there is none
+    if name in BUILTIN:
+        module, cls = BUILTIN[name]
+        return getattr(importlib.import_module(module), cls)
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return None
+    try:
+        found = entry_points(group=ENTRY_POINTS)
+    except TypeError:
+        # before python 3.10
+        found = entry_points().get(ENTRY_POINTS, ())
+    for entry_point in found:
+        if entry_point.name == name:
+            return entry_point.load()
+    return None
+
+
+class FileSink(Sink):
+    # one json document per line to a file or stdout (path = -), i.e. to run the whole pipeline
+    # without a broker
+    records = 'frame'
+    rollups = True
+
+    @classmethod
+    def read_settings(cls, section):
+        return {'path' : section.get('path', '-'), 'flush' : section.get('flush', 'True') == 'True'}
+
+    def __init__(self, name, settings, logger=None, workers=1):
+        super().__init__(name, settings, logger, workers)
+        path = settings['path']
+        self._file = sys.stdout if path == '-' else open(path, 'a', buffering=65536)
+
+    def write(self, document):
+        self._file.write(json.dumps(document, indent = None) + '\n')
+        if self._settings['flush']:
+            self._file.flush()
+
+    def publish(self, frame):
+        self.write({'bridge'    : frame['bridge'],
+                    'timestamp' : frame['timestamp'],
+                    'inverters' : [format_record(r) for r in frame['records']]})
+
+    def publish_rollup(self, rollup, topic):
+        self.write({'topic' : topic, **rollup})
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
@@ -0,0 +1,258 @@
+
+import os
+import time
+import zlib
+import pickle
+import struct
+import threading
+from log import log
+
+# Disk spool of the records a sink could not publish, replayed in order when it is back
+#
+# directory with numbered segment files (00000001.spl, ...), appended to and deleted once replayed
+# per record: length (uint32) crc32 of the data (uint32) pickled record
+# the read position (segment, offset) is kept in the file 'position'
+# Records are written by this process only, the directory must not be writable for others.
+# A record is removed after it was published, after a crash it may be published twice.
+FRAME    = struct.Struct('<II')
+SUFFIX   = '.spl'
+POSITION = 'position'
+
+
+class Spool:
+    # max_bytes:     size of all segments, if more is spooled policy decides
+    #                drop-oldest: the oldest segment is deleted, drop-newest: new records are dropped
+    # sync_interval: seconds between fsyncs of the segment, a crash of the machine loses at most that much,
+    #                each append is flushed to the os, so a crash of the process loses nothing.
+    #                The queue workers call sync_due, so the last records of a burst are synced in time.
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    POLICIES    = (DROP_OLDEST, DROP_NEWEST)
+
+    def __init__(self, directory, max_bytes=64 << 20, segment_size=1 << 20, sync_interval=1.0,
+                 policy=DROP_OLDEST, logger=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown spool policy {policy}')
+        self._log           = log('Spool') if logger is None else logger
+        self._directory     = directory
+        self._max_bytes     = max_bytes
+        self._segment_size  = segment_size
+        self._sync_interval = sync_interval
+        self._policy        = policy
+        self._lock          = threading.Lock()
+        self._segments      = []
+        self._file          = None
+        self._synced        = 0.0
+        self._dirty         = False
+        # read position
+        self._read_segment  = 0
+        self._read_offset   = 0
+        self._read_ends     = []
+        self._bytes         = 0
+        # stats
+        self.records        = 0
+        self.replayed       = 0
+        self.evicted        = 0
+
+    def __repr__(self):
+        return f'Spool({self._directory}, {self.records} records, {self._bytes} bytes)'
+
+    @property
+    def sync_interval(self):
+        return self._sync_interval
+
+    def path(self, segment):
+        return os.path.join(self._directory, f'{segment:08d}{SUFFIX}')
+
+    def check(self):
+        # raises OSError if the directory can not be used, before anything is spooled
+        os.makedirs(self._directory, exist_ok=True)
+        if not os.access(self._directory, os.W_OK | os.X_OK):
+            raise PermissionError(f'spool directory {self._directory} is not writable')
+
+    def open(self):
+        # the segments left by the last run are replayed first
+        os.makedirs(self._directory, exist_ok=True)
+        with self._lock:
+            self._segments = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(self._directory)
+                                    if name.endswith(SUFFIX))
+            self._read_segment, self._read_offset = self._segments[0] if self._segments else 1, 0
+            try:
+                with open(os.path.join(self._directory, POSITION)) as f:
+                    segment, offset = (int(x) for x in f.read().split())
+                if segment in self._segments:
+                    self._read_segment, self._read_offset = segment, offset
+            except (OSError, ValueError):
+                pass
+            for segment in list(self._segments):
+                if segment < self._read_segment:
+                    self.remove(segment)
+            self.records = 0
+            self._bytes = 0
+            for segment in self._segments:
+                self._bytes += os.path.getsize(self.path(segment))
+                self.records += self.count(segment, self._read_offset if segment == self._read_segment else 0)
+            if self.records:
+                self._log.logMsg(f'{self._directory}: {self.records} records to replay', log.INFO)
+
+    def count(self, segment, offset=0):
+        # records of a segment from offset, an incomplete record at the end (crash) is cut off
+        n = 0
+        with open(self.path(segment), 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            while True:
+                head = f.read(FRAME.size)
+                if len(head) < FRAME.size:
+                    break
+                length, crc = FRAME.unpack(head)
+                if f.tell() + length > size:
+                    break
+                offset = f.tell() + length
+                f.seek(offset)
+                n += 1
+            if offset < size:
+                f.truncate(offset)
+        return n
+
+    def remove(self, segment):
+        try:
+            self._bytes -= os.path.getsize(self.path(segment))
+            os.remove(self.path(segment))
+        except OSError as e:
+            self._log.logMsg(f'spool segment {segment} not removed: {e}', log.WARN)
+        self._segments.remove(segment)
+
+    def pending(self):
+        return self.records
+
+    def append(self, records):
+        # returns False if the records were dropped (drop-newest and the spool is full)
+        data = [pickle.dumps(record, pickle.HIGHEST_PROTOCOL) for record in records]
+        size = sum(len(d) + FRAME.size for d in data)
+        with self._lock:
+            while self._bytes + size > self._max_bytes:
+                if self._policy == self.DROP_NEWEST or len(self._segments) < 2:
+                    self.evicted += len(records)
+                    return False
+                self.evict()
+            if self._file is None or self._file.tell() >= self._segment_size:
+                self.new_segment()
+            for d in data:
+                self._file.write(FRAME.pack(len(d), zlib.crc32(d)))
+                self._file.write(d)
+            self._file.flush()
+            self._dirty = True
+            self._bytes += size
+            self.records += len(records)
+            now = time.monotonic()
+            if now - self._synced >= self._sync_interval:
+                self.sync(now)
+        return True
+
+    def evict(self):
+        # drop-oldest: the oldest segment goes, read or not
+        segment = self._segments[0]
+        n = self.count(segment, self._read_offset if segment == self._read_segment else 0)
+        self.records -= n
+        self.evicted += n
+        self.remove(segment)
+        self._read_segment, self._read_offset, self._read_ends = self._segments[0], 0, []
+        self._log.logMsg(f'spool {self._directory} full, {n} records dropped', log.WARN)
+
+    def new_segment(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+        segment = self._segments[-1] + 1 if self._segments else self._read_segment
+        self._file = open(self.path(segment), 'ab')
+        self._segments.append(segment)
+
+    def sync(self, now=None):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._dirty = False
+        self._synced = time.monotonic() if now is None else now
+
+    def dirty(self):
+        # records were written since the last fsync
+        return self._dirty
+
+    def sync_due(self):
+        # fsyncs the written records once sync_interval is over, without waiting for the next append
+        if not self._dirty:
+            return
+        with self._lock:
+            if self._dirty and time.monotonic() - self._synced >= self._sync_interval:
+                self.sync()
+
+    def read(self, limit):
+        # up to limit records from the read position, they stay in the spool until commit,
+        # a damaged record is returned as None
+        with self._lock:
+            records = []
+            while self.records and not records:
+                if self._file is not None and self._segments[-1] == self._read_segment:
+                    self._file.flush()
+                self._read_ends = []
+                with open(self.path(self._read_segment), 'rb') as f:
+                    f.seek(self._read_offset)
+                    while len(records) < limit:
+                        head = f.read(FRAME.size)
+                        if len(head) < FRAME.size:
+                            break
+                        length, crc = FRAME.unpack(head)
+                        data = f.read(length)
+                        if len(data) < length:
+                            break
+                        self._read_ends.append(f.tell())
+                        if zlib.crc32(data) != crc:
+                            self._log.logMsg(f'spool segment {self._read_segment} damaged record skipped', log.WARN)
+                            records.append(None)
+                        else:
+                            records.append(pickle.loads(data))
+                if not records:
+                    if self._segments[-1] == self._read_segment:
+                        break
+                    # end of the segment, go on with the next one
+                    self.next_segment()
+            return records
+
+    def commit(self, n):
+        # the first n records of the last read were published
+        if n <= 0:
+            return
+        with self._lock:
+            # records evicted meanwhile are not counted again
+            n = min(n, len(self._read_ends))
+            if not n:
+                return
+            self._read_offset = self._read_ends[n - 1]
+            del self._read_ends[:n]
+            self.records -= n
+            self.replayed += n
+            if self._segments[-1] != self._read_segment and self._read_offset >= os.path.getsize(self.path(self._read_segment)):
+                self.next_segment()
+            try:
+                with open(os.path.join(self._directory, POSITION), 'w') as f:
+                    f.write(f'{self._read_segment} {self._read_offset}')
+            except OSError as e:
+                self._log.logMsg(f'spool position not saved: {e}', log.WARN)
+
+    def next_segment(self):
+        # the read segment is done, it is removed unless it is written to
+        if self._segments and self._segments[-1] != self._read_segment:
+            self.remove(self._read_segment)
+            self._read_segment, self._read_offset = self._segments[0], 0
+        self._read_ends = []
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        return {'spooled' : self.records, 'replayed' : self.replayed, 'evicted' : self.evicted}
@@ -0,0 +1,203 @@
+
+import os
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+import multiprocessing.connection
+from log import log
+
+
+class Worker:
+    __slots__ = ('index', 'process', 'conn', 'lock', 'started', 'restarts')
+
+    def __init__(self, index):
+        self.index    = index
+        self.process  = None
+        # pipe to ask the worker for its metrics
+        self.conn     = None
+        self.lock     = threading.Lock()
+        self.started  = 0.0
+        self.restarts = 0
+
+
+class Supervisor:
+    # Runs target(index, records, logs, conn) in worker processes. They are started by the
+    # forkserver of multiprocessing (spawn if there is none), not forked from this process,
+    # which runs threads (sinks, log, metrics) whose locks a fork could copy while held.
+    # target and its arguments are pickled, so target is a module level function.
+    # The workers bind the listen port with SO_REUSEPORT, the kernel spreads the bridge
+    # connections over them.
+    # records: queue of decoded records, published by the parent in one stream
+    # logs:    queue of the log records of the workers, written by the parent
+    # conn:    pipe end, the worker answers each request with its metrics families
+    # A worker which exits while the supervisor is not stopping is restarted,
+    # after RESTART_DELAY seconds if it ran shorter than that.
+    # Tasks of call_every run in the thread which publishes the records, so they need no lock.
+    RESTART_DELAY = 5
+    METRICS_TIMEOUT = 2
+
+    def __init__(self, target, workers, publish, logger=None, metrics=None, reload=None):
+        self._log      = log('Supervisor') if logger is None else logger
+        self._target   = target
+        self._publish  = publish
+        # called on SIGHUP, the workers get the signal as well and reload themselves
+        self._reload   = reload
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._ctx      = multiprocessing.get_context(method)
+        self._records  = self._ctx.Queue()
+        self._logs     = self._ctx.Queue()
+        self._workers  = [Worker(i) for i in range(workers)]
+        self._stopping = threading.Event()
+        # [interval, callback, next run]
+        self._periodic = []
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+            metrics.add_source(self.worker_metrics)
+
+    def __repr__(self):
+        return f'Supervisor({len(self._workers)} workers)'
+
+    def start_worker(self, worker):
+        conn, child_conn = self._ctx.Pipe()
+        worker.process = self._ctx.Process(target=self._target, name=f'worker-{worker.index}',
+                                           args=(worker.index, self._records, self._logs, child_conn))
+        worker.process.start()
+        child_conn.close()
+        with worker.lock:
+            if worker.conn is not None:
+                worker.conn.close()
+            worker.conn = conn
+        worker.started = time.monotonic()
+        self._log.logMsg(f'worker {worker.index} started (pid {worker.process.pid})', log.INFO)
+
+    def call_every(self, interval, callback):
+        # callback() runs in the records thread every interval seconds while the supervisor runs
+        self._periodic.append([interval, callback, 0.0])
+
+    def receive_records(self):
+        now = time.monotonic()
+        for task in self._periodic:
+            task[2] = now + task[0]
+        while True:
+            timeout = None
+            if self._periodic:
+                timeout = max(min(task[2] for task in self._periodic) - time.monotonic(), 0)
+            try:
+                records = self._records.get(timeout=timeout)
+            except queue.Empty:
+                records = False
+            if records is None:
+                return
+            if records:
+                try:
+                    self._publish(records)
+                except Exception as e:
+                    self._log.logMsg(f'publish of worker records failed: {e!r}', log.ERROR)
+            self.run_periodic()
+
+    def run_periodic(self):
+        now = time.monotonic()
+        for task in self._periodic:
+            if now >= task[2]:
+                task[2] = now + task[0]
+                try:
+                    task[1]()
+                except Exception as e:
+                    self._log.logMsg(f'periodic task {task[1]} failed {e!r}', log.ERROR)
+
+    def stop(self, signum=None, frame=None):
+        self._stopping.set()
+
+    def reload(self, signum=None, frame=None):
+        self._log.logMsg('reload of the config', log.INFO)
+        if self._reload is not None:
+            self._reload()
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signal.SIGHUP)
+
+    def run(self):
+        logs = log.receive_from(self._logs)
+        receiver = threading.Thread(target=self.receive_records, name='records', daemon=True)
+        receiver.start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGHUP, self.reload)
+        for worker in self._workers:
+            self.start_worker(worker)
+        restart_at = {}
+        try:
+            while not self._stopping.is_set():
+                sentinels = {w.process.sentinel : w for w in self._workers if w not in restart_at}
+                for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=1):
+                    worker = sentinels[sentinel]
+                    worker.process.join()
+                    if self._stopping.is_set():
+                        break
+                    self._log.logMsg(f'worker {worker.index} exited with {worker.process.exitcode}', log.ERROR)
+                    delay = self.RESTART_DELAY if time.monotonic() - worker.started < self.RESTART_DELAY else 0
+                    restart_at[worker] = time.monotonic() + delay
+                now = time.monotonic()
+                for worker, at in list(restart_at.items()):
+                    if now >= at and not self._stopping.is_set():
+                        del restart_at[worker]
+                        worker.restarts += 1
+                        self.start_worker(worker)
+        finally:
+            self._log.logMsg('stopping workers', log.INFO)
+            for worker in self._workers:
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            for worker in self._workers:
+                worker.process.join(10)
+                if worker.process.is_alive():
+                    self._log.logMsg(f'worker {worker.index} does not stop, killed', log.WARN)
+                    worker.process.kill()
+                    worker.process.join()
+            self._records.put(None)
+            receiver.join(10)
+            logs.stop()
+
+    def collect_metrics(self):
+        yield ('supervisor_worker_up', 'gauge', 'worker process running',
+               [({'worker' : str(w.index)}, int(w.process is not None and w.process.is_alive())) for w in self._workers])
+        yield ('supervisor_worker_restarts_total', 'counter', 'restarts of the worker process',
+               [({'worker' : str(w.index)}, w.restarts) for w in self._workers])
+
+    def worker_metrics(self):
+        # metrics of all running workers, labeled by worker
+        families = []
+        for worker in self._workers:
+            if worker.process is None or not worker.process.is_alive():
+                continue
+            with worker.lock:
+                try:
+                    # drop a late answer to a previous request
+                    while worker.conn.poll():
+                        worker.conn.recv()
+                    worker.conn.send('metrics')
+                    if not worker.conn.poll(self.METRICS_TIMEOUT):
+                        self._log.logMsg(f'worker {worker.index} did not send metrics', log.WARN)
+                        continue
+                    received = worker.conn.recv()
+                except (OSError, EOFError) as e:
+                    self._log.logMsg(f'metrics of worker {worker.index} failed: {e}', log.WARN)
+                    continue
+            label = ('worker', str(worker.index))
+            for name, t, h, samples in received:
+                families.append((name, t, h, [(sample, tuple(sorted(labels + (label,))), value)
+                                              for sample, labels, value in samples]))
+        return families
+
+
+def answer_metrics(conn, metrics):
+    # worker side of Supervisor.worker_metrics
+    while True:
+        try:
+            conn.recv()
+            conn.send(metrics.families())
+        except (OSError, EOFError):
+            return
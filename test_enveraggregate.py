@@ -0,0 +1,51 @@
+
+import time
+from enveraggregate import Aggregator
+from enverstore import StoreWriter, energy_today
+
+NOON = time.mktime((2026, 6, 1, 12, 0, 0, 0, 0, -1))
+BRIDGE = b'\x12\x34\x56\x78'
+
+
+def record(wrid, power, total):
+    return {'wrid' : wrid, 'status' : 0x3021, 'power' : power, 'totalkwh' : total}
+
+
+def test_power_and_energy():
+    aggregator = Aggregator((60,))
+    aggregator.update([record(1, 100.0, 10.0), record(2, 50.0, 5.0)], BRIDGE, NOON)
+    rollup = aggregator.update([record(1, 200.0, 10.5), record(2, 0.0, 5.25)], BRIDGE, NOON + 30)
+    assert rollup['power'] == 200.0 and rollup['energy_today'] == 0.75
+    assert rollup['site']['energy_today'] == 0.75
+    assert rollup['inverters']['00000001']['windows']['60'] == {'min' : 100.0, 'max' : 200.0, 'avg' : 150.0}
+    # the window of the first value is over
+    rollup = aggregator.update([record(1, 300.0, 11.0)], BRIDGE, NOON + 61)
+    assert rollup['inverters']['00000001']['windows']['60'] == {'min' : 200.0, 'max' : 300.0, 'avg' : 250.0}
+
+
+def test_counter_reset_and_midnight():
+    aggregator = Aggregator((60,))
+    aggregator.update([record(1, 100.0, 10.0)], BRIDGE, NOON)
+    assert aggregator.update([record(1, 100.0, 0.5)], BRIDGE, NOON + 10)['energy_today'] == 0.5
+    assert aggregator.update([record(1, 100.0, 1.0)], BRIDGE, NOON + 13 * 3600)['energy_today'] == 0.5
+
+
+def test_seed_from_store(tmp_path):
+    store = StoreWriter(str(tmp_path))
+    for i, total in enumerate((10.0, 10.5, 11.0)):
+        store.append(record(1, 100.0, total), NOON - 3600 + i)
+    store.close()
+    aggregator = Aggregator((60,))
+    aggregator.seed(energy_today(str(tmp_path), NOON), NOON)
+    rollup = aggregator.update([record(1, 100.0, 11.25)], BRIDGE, NOON)
+    assert rollup['energy_today'] == 1.25 and rollup['site']['energy_today'] == 1.25
+    assert rollup['inverters']['00000001']['energy_today'] == 1.25
+
+
+def test_set_windows_keeps_energy():
+    aggregator = Aggregator((60,))
+    aggregator.update([record(1, 100.0, 10.0)], BRIDGE, NOON)
+    aggregator.update([record(1, 100.0, 10.5)], BRIDGE, NOON + 10)
+    aggregator.set_windows((60, 300))
+    rollup = aggregator.update([record(1, 100.0, 11.0)], BRIDGE, NOON + 20)
+    assert rollup['energy_today'] == 1.0 and sorted(rollup['windows']) == ['300', '60']
@@ -0,0 +1,43 @@
+
+
+from enverframe import EnverFrameParser
+from log import log
+
+LOG = log('test', 3, 'stdout')
+
+
+def frame(cmd='680030681006', payload=bytes(36)):
+    return bytes.fromhex(cmd) + bytes.fromhex('12345678') + payload + b'\x00\x16'
+
+
+def parse(reads):
+    parser = EnverFrameParser('client', LOG)
+    frames = []
+    for data in reads:
+        frames += [bytes(f) for f in parser.feed(data)]
+    return frames, parser.pending()
+
+
+def test_split_frames():
+    data = frame() + frame('680012681015', bytes(6))
+    for cut in range(1, len(data)):
+        assert parse([data[:cut], data[cut:]]) == ([frame(), frame('680012681015', bytes(6))], 0)
+    assert parse([data[i:i + 1] for i in range(len(data))]) == ([frame(), frame('680012681015', bytes(6))], 0)
+
+
+def test_frames_in_one_read():
+    frames, pending = parse([frame() * 3 + frame()[:10]])
+    assert frames == [frame()] * 3 and pending == 10
+
+
+def test_garbage():
+    data = b'\x00\x01' + frame() + b'\x68\x00\x02\x68\x00\x00' + b'\x68\x00\x10\x68' + bytes(12) + frame()
+    assert parse([data]) == ([frame(), frame()], 0)
+    assert parse([b'garbage']) == ([], 0)
+
+
+def test_corrupt_length():
+    # a header with a length beyond the largest frame does not stall the following frames
+    data = b'\x68\x40\x00\x68' + frame() * 20
+    assert parse([data]) == ([frame()] * 20, 0)
+    assert parse([memoryview(bytearray(b'\x00' * 5 + frame()))]) == ([frame()], 0)
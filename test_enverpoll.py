@@ -0,0 +1,79 @@
+
+from enverpoll import PollResponder
+
+
+def frame(cmd, payload=b'', account='12345678'):
+    return bytes.fromhex(cmd) + bytes.fromhex(account) + payload + b'\x00\x16'
+
+
+POLL     = frame('680030681006', bytes(36))
+WRID_ACK = frame('680030681010', bytes(36))
+DATA     = frame('6803d6681004', bytes(10))
+ACK      = frame('680012681015', bytes(4))
+ANSWER   = frame('680020681027', bytes(12))
+TIME     = frame('68001e681070', bytes(10))
+COMMAND  = frame('680030681007', bytes(36))
+
+
+def test_rate_limit():
+    polls = PollResponder(60)
+    assert polls.local(POLL, 0) is None
+    polls.answer(ANSWER)
+    assert polls.local(POLL, 10) == ANSWER
+    assert polls.local(POLL, 59) == ANSWER
+    # the interval is over, forwarded again
+    assert polls.local(POLL, 60) is None
+    assert polls.local(POLL, 61) == ANSWER
+
+
+def test_forwarded_until_answered():
+    polls = PollResponder(60)
+    assert polls.local(POLL, 0) is None
+    assert polls.local(POLL, 1) is None
+    polls.answer(ANSWER)
+    assert polls.local(POLL, 2) == ANSWER
+
+
+def test_data_frames_pass():
+    polls = PollResponder(60)
+    assert polls.local(DATA, 0) is None and polls.local(DATA, 1) is None
+
+
+def test_answer_after_data_frame():
+    polls = PollResponder(60)
+    polls.local(POLL, 0)
+    polls.local(DATA, 1)
+    polls.answer(ACK)
+    polls.answer(ANSWER)
+    assert polls.local(POLL, 2) == ANSWER
+
+
+def test_unanswered_ack():
+    polls = PollResponder(60)
+    polls.local(WRID_ACK, 0)
+    polls.local(POLL, 1)
+    polls.answer(ANSWER)
+    assert polls.local(POLL, 2) == ANSWER
+    assert polls.local(WRID_ACK, 3) is None
+    polls.answer(TIME)
+    assert polls.local(WRID_ACK, 4) == TIME
+    assert polls.local(POLL, 5) == ANSWER
+
+
+def test_commands_not_replayed():
+    polls = PollResponder(60)
+    polls.local(POLL, 0)
+    polls.answer(COMMAND)
+    assert polls.local(POLL, 1) is None
+    polls.answer(ANSWER)
+    assert polls.local(POLL, 2) == ANSWER
+
+
+def test_per_bridge():
+    polls = PollResponder(60)
+    other = frame('680030681006', bytes(36), '87654321')
+    polls.local(POLL, 0)
+    polls.local(other, 0)
+    polls.answer(ANSWER)
+    assert polls.local(POLL, 1) == ANSWER
+    assert polls.local(other, 1) is None
@@ -0,0 +1,80 @@
+
+import pytest
+
+# resolver.py needs pydns
+pytest.importorskip('DNS')
+
+from enverproxy import Enverproxy
+from log import log
+
+LOG = log('test', 3, 'stdout')
+
+CONFIG = """[enverproxy]
+listen_ip = 127.0.0.1
+listen_port = 0
+forward_ip = 127.0.0.1
+forward_port = 10013
+{enverproxy}
+[log]
+log_level = 3
+log_type = stdout
+[file]
+path = {path}
+{sections}
+"""
+
+
+def write(config, path, enverproxy='', sections=''):
+    config.write_text(CONFIG.format(enverproxy=enverproxy, path=path, sections=sections))
+
+
+@pytest.fixture
+def proxy(tmp_path):
+    config = tmp_path / 'enverproxy.conf'
+    write(config, tmp_path / 'out.json')
+    proxy = Enverproxy(str(config), LOG)
+    yield proxy, config
+    for group in proxy._sink_groups.values():
+        proxy.close_sinks(group)
+    proxy._iotserver._listener.close()
+
+
+def test_unchanged(proxy):
+    proxy, config = proxy
+    assert proxy.reload()
+
+
+def test_reload_applies(proxy, tmp_path):
+    proxy, config = proxy
+    old = proxy._sink_groups['file']
+    write(config, tmp_path / 'other.json', 'local_polls = True\nforward_backoff = 7\nidle_timeout = 60',
+          '[aggregate]\nwindows = 60')
+    assert proxy.reload()
+    assert proxy._sink_groups['file'] is not old
+    assert proxy._sink_groups['file'][2]._settings['path'] == str(tmp_path / 'other.json')
+    assert proxy._polls is not None and proxy._iotserver._local_first == proxy._polls.local
+    assert proxy._forward == (10, 7, 300) and proxy._iotserver._idle_timeout == 60
+    aggregator = proxy._aggregator
+    write(config, tmp_path / 'other.json', 'local_polls = True\nforward_backoff = 7\nidle_timeout = 60',
+          '[aggregate]\nwindows = 60, 300')
+    assert proxy.reload()
+    # the energy of today is kept
+    assert proxy._aggregator is aggregator
+    assert proxy._settings['aggregate'][0] == (60, 300)
+
+
+def test_invalid_config_changes_nothing(proxy, tmp_path):
+    proxy, config = proxy
+    settings, groups = proxy._settings, dict(proxy._sink_groups)
+    write(config, tmp_path / 'other.json', 'queue_policy = never')
+    assert not proxy.reload()
+    assert proxy._settings is settings and proxy._sink_groups == groups
+
+
+def test_unusable_spool_changes_nothing(proxy, tmp_path):
+    proxy, config = proxy
+    settings, groups = proxy._settings, dict(proxy._sink_groups)
+    (tmp_path / 'file').write_text('')
+    write(config, tmp_path / 'out.json', f"spool = {tmp_path / 'file' / 'spool'}")
+    assert not proxy.reload()
+    assert proxy._settings is settings and proxy._sink_groups == groups
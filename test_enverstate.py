@@ -0,0 +1,40 @@
+
+from enverstate import StateCache
+
+
+def test_heartbeat_due():
+    state = StateCache({'power' : 1}, heartbeat=300)
+    state.changes({'wrid' : 1, 'power' : 100.0}, 0, b'\x12\x34\x56\x78')
+    state.changes({'wrid' : 1, 'power' : 100.5}, 100, b'\x12\x34\x56\x78')
+    assert state.due(299) == []
+    # no frame since, the last values are due
+    assert state.due(300) == [(b'\x12\x34\x56\x78', {'wrid' : 1, 'power' : 100.0})]
+    assert state.due(301) == []
+    assert StateCache(heartbeat=0).due(1000) == []
+
+
+def test_deadbands():
+    state = StateCache({'power' : 1, 'temp' : 0.5}, heartbeat=300)
+    first = {'wrid' : 1, 'power' : 100.0, 'temp' : 30.0, 'status' : 0x3021}
+    assert state.changes(first, 0) == first
+    assert state.changes({'wrid' : 1, 'power' : 100.5, 'temp' : 30.0, 'status' : 0x3021}, 1) is None
+    assert state.changes({'wrid' : 1, 'power' : 101.5, 'temp' : 30.2, 'status' : 0x3021}, 2) == {'wrid' : 1, 'power' : 101.5}
+    # fields without deadband are published on any change
+    assert state.changes({'wrid' : 1, 'power' : 101.5, 'temp' : 30.2, 'status' : 0x3022}, 3) == {'wrid' : 1, 'status' : 0x3022}
+
+
+def test_standby_keeps_values():
+    state = StateCache(heartbeat=300)
+    state.changes({'wrid' : 1, 'power' : 100.0, 'temp' : 30.0}, 0)
+    # standby records miss power and temp
+    assert state.changes({'wrid' : 1}, 1) is None
+    assert state.last(1) == {'wrid' : 1, 'power' : 100.0, 'temp' : 30.0}
+
+
+def test_heartbeat_with_frame():
+    state = StateCache({'power' : 1}, heartbeat=300)
+    state.changes({'wrid' : 1, 'power' : 100.0}, 0)
+    assert state.changes({'wrid' : 1, 'power' : 100.0}, 299) is None
+    assert state.changes({'wrid' : 1, 'power' : 100.0}, 300) == {'wrid' : 1, 'power' : 100.0}
+    state.forget(1)
+    assert state.changes({'wrid' : 1, 'power' : 100.0}, 301) == {'wrid' : 1, 'power' : 100.0}
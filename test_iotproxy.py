@@ -0,0 +1,92 @@
+
+import time
+import socket
+import asyncio
+import threading
+import iotproxy
+from iotproxy import Circuit
+from log import log
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def circuit(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(iotproxy.time, 'monotonic', clock)
+    return Circuit(5, 20), clock
+
+
+def test_backoff(monkeypatch):
+    c, clock = circuit(monkeypatch)
+    assert c.allow()
+    assert c.failure(clock.now) == 5
+    assert not c.allow()
+    clock.now += 5
+    # one probe
+    assert c.allow() and c.state == Circuit.HALF_OPEN
+    assert not c.allow()
+    assert c.failure(clock.now) == 10
+    clock.now += 10
+    assert c.allow()
+    assert c.failure(clock.now) == 20
+    clock.now += 20
+    assert c.allow()
+    assert c.failure(clock.now) == 20
+    clock.now += 20
+    assert c.allow()
+    c.success()
+    assert c.state == Circuit.CLOSED and c.allow()
+    assert c.failure(clock.now) == 5
+
+
+def test_concurrent_failures_count_once(monkeypatch):
+    c, clock = circuit(monkeypatch)
+    started = clock.now
+    clock.now += 1
+    assert [c.failure(started) for _ in range(5)] == [5] * 5
+    clock.now += 5
+    assert c.allow()
+    assert c.failure(clock.now) == 10
+
+
+def test_cancelled_probe(monkeypatch):
+    c, clock = circuit(monkeypatch)
+    c.failure(clock.now)
+    clock.now += 5
+    assert c.allow() and not c.allow()
+    # the probe was cancelled, the next connect probes again
+    c.abandon()
+    assert c.state == Circuit.OPEN
+    assert c.allow() and c.state == Circuit.HALF_OPEN
+
+
+def test_disconnect_during_probe():
+    # a bridge which disconnects while its connect is the probe does not keep the circuit half open
+    proxy = iotproxy.TCPProxy('127.0.0.1', 0, '127.0.0.1', 9, log('test', 3, 'stdout'))
+    async def hang(session):
+        await asyncio.sleep(60)
+    proxy.create_forward = hang
+    proxy._circuit.failure()
+    proxy._circuit._retry_at = 0
+    thread = threading.Thread(target=proxy.loop, daemon=True)
+    thread.start()
+    try:
+        bridge = socket.create_connection(proxy._listener.getsockname())
+        bridge.sendall(b'\x68\x00\x08\x68\x10\x06\x00\x16')
+        deadline = time.monotonic() + 2
+        while proxy._circuit.state != Circuit.HALF_OPEN and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert proxy._circuit.state == Circuit.HALF_OPEN
+        bridge.close()
+        while proxy._circuit.state == Circuit.HALF_OPEN and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert proxy._circuit.state == Circuit.OPEN and proxy._circuit.allow()
+    finally:
+        proxy.stop()
+        thread.join(2)
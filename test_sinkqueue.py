@@ -0,0 +1,102 @@
+
+import time
+import threading
+from sinkqueue import SinkQueue
+from spool import Spool
+from log import log
+
+LOG = log('test', 3, 'stdout')
+
+
+def drain(queue):
+    queue.start()
+    queue.stop(2)
+    return queue.stats()
+
+
+def test_drop_oldest():
+    got = []
+    queue = SinkQueue('test', got.append, 3, SinkQueue.DROP_OLDEST, logger=LOG)
+    for i in range(5):
+        queue.put({'wrid' : i})
+    stats = drain(queue)
+    assert got == [{'wrid' : i} for i in range(2, 5)]
+    assert (stats['published'], stats['dropped']) == (3, 2)
+
+
+def test_coalesce():
+    got = []
+    queue = SinkQueue('test', got.append, 2, SinkQueue.COALESCE, logger=LOG)
+    queue.put({'wrid' : 1, 'power' : 1})
+    queue.put({'wrid' : 2, 'power' : 2})
+    queue.put({'wrid' : 1, 'temp' : 3})
+    # full, no record of wrid 3 queued: the oldest goes
+    queue.put({'wrid' : 3, 'power' : 4})
+    stats = drain(queue)
+    assert got == [{'wrid' : 2, 'power' : 2}, {'wrid' : 3, 'power' : 4}]
+    assert (stats['coalesced'], stats['dropped']) == (1, 1)
+
+
+def test_block():
+    got = []
+    gate = threading.Event()
+    def publish(values):
+        gate.wait(2)
+        got.append(values)
+    queue = SinkQueue('test', publish, 1, SinkQueue.BLOCK, logger=LOG)
+    queue.start()
+    queue.put({'wrid' : 0})
+    queue.put({'wrid' : 1})
+    putter = threading.Thread(target=queue.put, args=({'wrid' : 2},))
+    putter.start()
+    time.sleep(0.1)
+    # the producer waits for room
+    assert putter.is_alive()
+    gate.set()
+    putter.join(2)
+    queue.stop(2)
+    assert got == [{'wrid' : i} for i in range(3)] and queue.stats()['dropped'] == 0
+
+
+def test_batch():
+    got = []
+    queue = SinkQueue('test', got.append, 10, logger=LOG, batch=3)
+    for i in range(5):
+        queue.put({'wrid' : i})
+    drain(queue)
+    assert [len(b) for b in got] == [3, 2]
+
+
+def test_failed_publish_is_dropped():
+    def down(values):
+        raise ConnectionError('down')
+    queue = SinkQueue('test', down, 10, logger=LOG)
+    for i in range(5):
+        queue.put({'wrid' : i})
+    stats = drain(queue)
+    assert (stats['published'], stats['errors'], stats['dropped']) == (0, 5, 5)
+
+
+def test_spooled_until_replayed(tmp_path):
+    got = []
+    down = [True]
+    def publish(values):
+        if down[0]:
+            raise ConnectionError('down')
+        got.append(values)
+    queue = SinkQueue('test', publish, 10, logger=LOG, spool=Spool(str(tmp_path), logger=LOG), retry=0.1)
+    queue.start()
+    for i in range(5):
+        queue.put({'wrid' : i})
+    time.sleep(0.2)
+    stats = queue.stats()
+    assert (stats['published'], stats['dropped'], stats['spooled']) == (0, 0, 5)
+    down[0] = False
+    queue.put({'wrid' : 5})
+    deadline = time.monotonic() + 3
+    while queue.stats()['spooled'] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    queue.stop(2)
+    stats = queue.stats()
+    assert got == [{'wrid' : i} for i in range(6)]
+    assert (stats['published'], stats['replayed'], stats['dropped']) == (6, 6, 0)
@@ -0,0 +1,87 @@
+
+import os
+import time
+from spool import Spool, FRAME, POSITION
+from sinkqueue import SinkQueue
+from log import log
+
+LOG = log('test', 3, 'stdout')
+
+
+def spool(directory, **kw):
+    s = Spool(str(directory), logger=LOG, **kw)
+    s.open()
+    return s
+
+
+def test_spool_torn_record(tmp_path):
+    s = spool(tmp_path)
+    assert s.append([{'wrid' : i} for i in range(3)])
+    s.close()
+    # a crash in the middle of the last record
+    segment = tmp_path / '00000001.spl'
+    size = segment.stat().st_size
+    with open(segment, 'r+b') as f:
+        f.truncate(size - 3)
+    s = spool(tmp_path)
+    assert s.pending() == 2
+    assert s.read(10) == [{'wrid' : 0}, {'wrid' : 1}]
+    # appended after the cut off record
+    assert s.append([{'wrid' : 3}])
+    s.commit(2)
+    assert s.read(10) == [{'wrid' : 3}]
+
+
+def test_spool_read_position(tmp_path):
+    s = spool(tmp_path, segment_size=FRAME.size)
+    s.append([{'wrid' : i} for i in range(2)])
+    s.append([{'wrid' : i} for i in range(2, 5)])
+    assert s.read(3) == [{'wrid' : 0}, {'wrid' : 1}]
+    s.commit(1)
+    s.close()
+    # the first segment holds two records of the same size
+    with open(tmp_path / POSITION) as f:
+        assert f.read().split() == ['1', str(os.path.getsize(tmp_path / '00000001.spl') // 2)]
+    # after a restart the published record is not replayed again
+    s = spool(tmp_path)
+    assert s.pending() == 4
+    records = []
+    while s.pending():
+        batch = s.read(10)
+        records += batch
+        s.commit(len(batch))
+    assert records == [{'wrid' : i} for i in range(1, 5)]
+    assert sorted(os.listdir(tmp_path)) == ['00000002.spl', POSITION]
+
+
+def test_spool_unclosed(tmp_path):
+    # a burst is readable after a crash of the process without close
+    s = spool(tmp_path, sync_interval=60)
+    s.append([{'wrid' : 0}])
+    s.append([{'wrid' : i} for i in range(1, 30)])
+    assert s.dirty()
+    s = spool(tmp_path)
+    assert s.read(100) == [{'wrid' : i} for i in range(30)]
+
+
+def test_spool_sync_due(tmp_path):
+    s = spool(tmp_path, sync_interval=0.05)
+    s.append([{'wrid' : 0}])
+    s.append([{'wrid' : 1}])
+    assert s.dirty()
+    time.sleep(0.06)
+    s.sync_due()
+    assert not s.dirty()
+
+
+def test_queue_syncs_spool(tmp_path):
+    def down(values):
+        raise ConnectionError('down')
+    s = Spool(str(tmp_path), sync_interval=0.05, logger=LOG)
+    queue = SinkQueue('test', down, logger=LOG, spool=s, retry=60)
+    queue.start()
+    for i in range(3):
+        queue.put({'wrid' : i})
+    time.sleep(0.3)
+    assert s.pending() == 3 and not s.dirty()
+    queue.stop(0.1)